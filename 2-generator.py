@@ -43,11 +43,20 @@ if __name__ == '__main__':
     else:
       gen.load_traits()
 
-    gen.validate_rules()
-    gen.randomize()
-    #gen.randomize_last()
-    #gen.customize()
-    gen.generate_items()
+    if gen.metadata_only_path:
+      gen.generate_metadata( gen.metadata_only_path )
+    else:
+      gen.validate_rules()
+      if gen.count_only:
+        gen.count_items()
+      elif gen.stats_path:
+        gen.check_distribution( gen.stats_path )
+      else:
+        gen.randomize()
+        #gen.randomize_last()
+        #gen.customize()
+        if not gen.STREAM_ITEMS:
+          gen.generate_items()
 
   except Exception as ex:
     logging.exception( ex )
@@ -13,6 +13,8 @@ from queue import Queue
 from threading import Thread
 from PIL import Image
 
+from encoders import ImageEncoder
+
 #google sheets
 from oauth2client.service_account import ServiceAccountCredentials
 from googleapiclient import discovery
@@ -34,13 +36,35 @@ class TraitGenerator:
     self.use_procs = 0
     self.use_threads = 0
 
+    # OUTPUT_FORMAT is the generator's, so --config can share its file
+    self.OUTPUT_FORMAT = 'png'
     self.RESIZE = (2000,2000)
+    self.THUMB_FORMAT = 'jpg'
+    self.THUMB_OPTIONS = {}
 
 
   def __exit__(self, exc_type, exc_val, exc_tb):
     self.stop()
 
 
+  def configure(self):
+    args = sys.argv.copy()
+    args.pop(0)
+
+    for arg in args:
+      key, _, value = arg.partition('=')
+      if key == '--config':
+        logging.info( value )
+        with open( value ) as fd:
+          config = json.load( fd )
+
+        for (key, value) in config.items():
+          setattr( self, key, value )
+
+      else:
+        logging.warning( f"Ignoring argument '{key}': '{value}'" )
+
+
   def init(self):
     try:
       self.images_path = os.path.join( self.base_path, '2-images' )
@@ -54,6 +78,9 @@ class TraitGenerator:
     except FileExistsError:
       pass
 
+    self.encoder = ImageEncoder( self.THUMB_FORMAT, self.THUMB_OPTIONS )
+    self.images_extension = ImageEncoder( self.OUTPUT_FORMAT ).extension
+
 
   def generate_thumbs(self):
     if False and self.use_procs:
@@ -81,23 +108,13 @@ class TraitGenerator:
     else:
       for i in range(8888):
         if self.is_running:
-          from_path = os.path.join(self.images_path, "{0}.png".format(i))
-          to_path = os.path.join(self.thumbs_path, "{0}.jpg".format(i))
+          from_path = os.path.join(self.images_path, "{0}{1}".format(i, self.images_extension))
+          to_path = os.path.join(self.thumbs_path, "{0}{1}".format(i, self.encoder.extension))
           if os.path.isfile(from_path) and not os.path.isfile(to_path):
             from_image = Image.open(from_path)
             resized = from_image.resize(self.RESIZE)
-            
-            (_, ext) = os.path.splitext(to_path)
-            if ext.lower() == '.jpg':
-              # if converting to jpg (non-alpha)
-              converted = resized.convert('RGB')
-              converted.save(to_path)
-              converted.close()
-              resized.close()
-
-            else:
-              resized.save(to_path)
-              resized.close()
+            self.encoder.save(resized, to_path)
+            resized.close()
 
             from_image.close()
             logging.info("CREATED: Image {0}".format(i))
@@ -153,6 +170,7 @@ if __name__ == '__main__':
     # Linux: Ctrl + C
     signal.signal( signal.SIGINT,   gen.signal_interrupt )
 
+    gen.configure()
     gen.init()
     gen.generate_thumbs()
 
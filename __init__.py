@@ -1 +1 @@
-__all__ = ['1-loader', '2-generator', 'data', 'impl', 'procs', 'threads', 'util']
\ No newline at end of file
+__all__ = ['1-loader', '2-generator', 'compositors', 'counters', 'data', 'encoders', 'impl', 'items', 'layers', 'links', 'pipeline', 'procs', 'rules', 'samplers', 'stats', 'threads', 'util']
\ No newline at end of file
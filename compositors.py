@@ -0,0 +1,113 @@
+
+from PIL import Image
+
+# optional
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+
+class PillowCompositor(object):
+  name = 'pillow'
+
+  def blend(self, canvas, layer):
+    return layer.composite(canvas)
+
+
+  def copy(self, canvas):
+    return canvas.copy()
+
+
+  def nbytes(self, canvas):
+    width, height = canvas.size
+    return width * height * 4
+
+
+  def new_canvas(self, layer):
+    return layer.to_canvas()
+
+
+  def prepare(self, layer):
+    return 0
+
+
+  def to_image(self, canvas):
+    return canvas
+
+
+
+class NumpyCompositor(object):
+  # canvas: float32 (height, width, 4) where colors are premultiplied by alpha (c * a)
+  name = 'numpy'
+
+  def __init__(self):
+    if np is None:
+      raise NotImplementedError("The 'numpy' compositor requires numpy: pip install numpy")
+
+
+  def blend(self, canvas, layer):
+    if layer.image:
+      pixels = self.get_pixels(layer)
+      x, y = layer.offset
+      height, width = pixels.shape[:2]
+      region = canvas[y:y + height, x:x + width]
+
+      # source over: out = src + out * (1 - src_a)
+      region *= (255 - pixels[..., 3:4]) / np.float32(255)
+      region += pixels
+
+    return canvas
+
+
+  def copy(self, canvas):
+    return canvas.copy()
+
+
+  @staticmethod
+  def get_pixels(layer):
+    if layer.pixels is None:
+      # uint16 is enough for c * a (<= 65025) without losing precision
+      pixels = np.asarray(layer.image, dtype=np.uint16)
+      premultiplied = np.empty_like(pixels)
+      premultiplied[..., :3] = pixels[..., :3] * pixels[..., 3:4]
+      premultiplied[..., 3] = pixels[..., 3]
+      return premultiplied
+
+    return layer.pixels
+
+
+  def nbytes(self, canvas):
+    return canvas.nbytes
+
+
+  def new_canvas(self, layer):
+    width, height = layer.size
+    canvas = np.zeros((height, width, 4), dtype=np.float32)
+    return self.blend(canvas, layer)
+
+
+  def prepare(self, layer):
+    # keep the premultiplied pixels with cached layers
+    if layer.image and layer.pixels is None:
+      layer.pixels = self.get_pixels(layer)
+      return layer.pixels.nbytes
+
+    return 0
+
+
+  def to_image(self, canvas):
+    alpha = canvas[..., 3:4]
+    colors = np.divide(canvas[..., :3], alpha, out=np.zeros_like(canvas[..., :3]), where=alpha > 0)
+
+    pixels = np.empty(canvas.shape, dtype=np.uint8)
+    pixels[..., :3] = np.clip(np.rint(colors), 0, 255)
+    pixels[..., 3] = np.clip(np.rint(canvas[..., 3]), 0, 255)
+    return Image.fromarray(pixels, 'RGBA')
+
+
+
+COMPOSITORS = {
+  PillowCompositor.name: PillowCompositor,
+  NumpyCompositor.name:  NumpyCompositor
+}
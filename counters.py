@@ -0,0 +1,297 @@
+
+import itertools, logging, math, random
+
+
+class RecipeCounter(object):
+  # counts the unique valid items of BASE_TRAITS (links included) without drawing them
+  def __init__(self, weights, populations, traits, rule_set, limit=1000000):
+    # weights, populations: the output of TraitManager.compile_base_traits()
+    self.features = list(populations.keys())
+    self.limit = limit
+    self.populations = populations
+    self.rule_set = rule_set
+    self.traits = traits
+
+    self.probabilities = {}
+    for feature, population in populations.items():
+      if weights[feature]:
+        total = sum(weights[feature])
+        self.probabilities[feature] = [weight / total for weight in weights[feature]]
+      else:
+        self.probabilities[feature] = [1 / len(population)] * len(population)
+
+    # (feature, expression) => [(linked features, probability)]
+    self.outcomes = {}
+
+    # feature => features it can reach through link:feature
+    self.reachable = {}
+    for feature in self.features:
+      self.reachable[feature] = self.get_reachable(feature)
+
+
+  def count(self):
+    # returns (count, probability that a random draw is valid, margin); margin is 0 if exact
+    total = 1
+    probability = 1.0
+    margin = 0.0
+    for features, is_constrained in self.get_components():
+      if is_constrained or self.has_overwrites(features):
+        count, p, error = self.count_component(features)
+      else:
+        # no rules and no links between them: every combination is valid and unique
+        count = 1
+        for feature in features:
+          count *= sum(len(self.get_outcomes(feature, expression)) for expression in self.populations[feature])
+
+        p, error = 1.0, 0
+
+      if error:
+        logging.info(f"COUNT: {features} ~{count} ± {error} valid, {p:.2%} of draws")
+        margin += error / count if count else math.inf
+      else:
+        logging.debug(f"COUNT: {features} {count} valid, {p:.2%} of draws")
+
+      total *= count
+      probability *= p
+
+    # relative errors add up (to first order) in a product
+    return (total, probability, round(margin * total) if margin < math.inf else margin)
+
+
+  def count_component(self, features):
+    # exact depth-first count, or estimate_component() past self.limit combinations
+    space = 1
+    for feature in features:
+      space *= sum(len(self.get_outcomes(feature, expression)) for expression in self.populations[feature])
+
+    if space > self.limit:
+      logging.warning(f"COUNT: {features} has {space} combinations, more than {self.limit}, estimating")
+      return self.estimate_component(features)
+
+    prune = not self.has_overwrites(features)
+    seen = None if prune else set()
+
+    item = {}
+    decided = set()
+    totals = [0, 0.0, 0]
+
+    def visit(depth, p):
+      # False once there are more than self.limit combinations
+      if depth == len(features):
+        totals[2] += 1
+        if totals[2] > self.limit:
+          return False
+
+        for linked, q in self.get_item_outcomes(item, features):
+          full = { **item, **linked }
+          if not self.rule_set.is_valid(full, record=False):
+            continue
+
+          totals[1] += p * q
+          if seen is not None:
+            key = tuple(sorted(full.items()))
+            if key in seen:
+              continue
+
+            seen.add(key)
+
+          totals[0] += 1
+
+        return True
+
+
+      feature = features[depth]
+      population = self.populations[feature]
+      decided.add(feature)
+      if prune:
+        codes = self.rule_set.get_allowed(feature, population, item, decided)
+      else:
+        codes = range(len(population))
+
+      probabilities = self.probabilities[feature]
+      for code in codes:
+        item[feature] = population[code]
+        if not visit(depth + 1, p * probabilities[code]):
+          return False
+
+      item.pop(feature, None)
+      decided.discard(feature)
+      return True
+
+
+    if not visit(0, 1.0):
+      logging.warning(f"COUNT: {features} has more than {self.limit} combinations, estimating")
+      return self.estimate_component(features)
+
+    return (totals[0], totals[1], 0)
+
+
+  def estimate_component(self, features, samples=20000, rng=None):
+    # Monte Carlo: uniform draws estimate the count, weighted draws the probability
+    rng = rng or random.Random(0)
+    choices = []
+    space = 1
+    for feature in features:
+      pairs = [(expression, linked) for expression in self.populations[feature] for linked, _ in self.get_outcomes(feature, expression)]
+      choices.append(pairs)
+      space *= len(pairs)
+
+    uniform = 0
+    for _ in range(samples):
+      item = {}
+      linked = {}
+      for feature, pairs in zip(features, choices):
+        item[feature], outcome = rng.choice(pairs)
+        linked.update(outcome)
+
+      if self.rule_set.is_valid({ **item, **linked }, record=False):
+        uniform += 1
+
+    weighted = 0
+    for _ in range(samples):
+      item = {}
+      for feature in features:
+        item[feature], = rng.choices(self.populations[feature], weights=self.probabilities[feature])
+
+      outcomes = list(self.get_item_outcomes(item, features))
+      linked, = rng.choices([linked for linked, _ in outcomes], weights=[q for _, q in outcomes])
+      if self.rule_set.is_valid({ **item, **linked }, record=False):
+        weighted += 1
+
+    # 95% confidence interval on the count
+    fraction = uniform / samples
+    error = 1.96 * space * math.sqrt(fraction * (1 - fraction) / samples)
+    return (round(space * fraction), weighted / samples, max(1, round(error)))
+
+
+  def get_components(self):
+    # groups BASE_TRAITS that share rules or linked features; returns [(features, is_constrained)]
+    parents = { feature: feature for feature in self.features }
+
+    def find(feature):
+      while parents[feature] != feature:
+        parents[feature] = parents[parents[feature]]
+        feature = parents[feature]
+
+      return feature
+
+    def union(features):
+      roots = [find(feature) for feature in features]
+      for root in roots[1:]:
+        parents[root] = roots[0]
+
+
+    for a, b in itertools.combinations(self.features, 2):
+      if self.reachable[a] & self.reachable[b]:
+        union((a, b))
+
+    constrained = set()
+    for rule_id, compiled in enumerate(self.rule_set.compiled):
+      if compiled is None:
+        continue
+
+      feature, _ = self.rule_set.matches[rule_id]
+      _, checks = compiled
+      rule_features = { feature, *(feature for feature, _ in checks or ()) }
+      touched = [feature for feature in self.features if self.reachable[feature] & rule_features]
+      if touched:
+        union(touched)
+        constrained.add(touched[0])
+
+
+    components = {}
+    for feature in self.features:
+      components.setdefault(find(feature), []).append(feature)
+
+    constrained = { find(feature) for feature in constrained }
+    return [(features, root in constrained) for root, features in components.items()]
+
+
+  def get_item_outcomes(self, item, features):
+    # links are applied in feature order, like TraitManager.process_links()
+    for outcome in itertools.product(*[self.get_outcomes(feature, item[feature]) for feature in features]):
+      linked = {}
+      q = 1.0
+      for features_linked, r in outcome:
+        linked.update(features_linked)
+        q *= r
+
+      yield (linked, q)
+
+
+  def get_options(self, feature):
+    # the expressions TraitManager.randomize_trait() can return, with probabilities
+    traits = list(self.traits[feature].values())
+    if not traits:
+      return [('', 1.0)]
+
+    weights = [trait['mils'] for trait in traits]
+    if len(set(weights)) == 1:
+      weights = [1] * len(traits)
+
+    total = sum(weights)
+    return [(trait['expression'], weight / total) for trait, weight in zip(traits, weights) if weight]
+
+
+  def get_outcomes(self, feature, expression):
+    try:
+      return self.outcomes[(feature, expression)]
+    except KeyError:
+      pass
+
+    # follow the link chain, branching on '*'
+    outcomes = {}
+    stack = [(feature, expression, (), 1.0, 0)]
+    while stack:
+      key, value, linked, p, depth = stack.pop()
+      if depth > len(self.traits):
+        raise Exception(f"Links starting at {feature} '{expression}' don't terminate")
+
+      trait = self.traits[key][value]
+      key = trait['link:feature']
+      if not key:
+        # different branches can end with the same features
+        linked = tuple(dict(linked).items())
+        outcomes[linked] = outcomes.get(linked, 0.0) + p
+        continue
+
+      if trait['link:expression'] == '*':
+        options = self.get_options(key)
+      else:
+        options = [(trait['link:expression'], 1.0)]
+
+      for value, q in options:
+        stack.append((key, value, (*linked, (key, value)), p * q, depth + 1))
+
+    self.outcomes[(feature, expression)] = [(dict(linked), p) for linked, p in outcomes.items()]
+    return self.outcomes[(feature, expression)]
+
+
+  def get_reachable(self, feature):
+    reachable = { feature }
+    pending = [feature]
+    while pending:
+      for trait in self.traits.get(pending.pop(), {}).values():
+        linked = trait['link:feature']
+        if linked and linked not in reachable:
+          reachable.add(linked)
+          pending.append(linked)
+
+    return reachable
+
+
+  def has_overwrites(self, features):
+    # a link that sets a base trait, or a feature that two base traits link to,
+    # can merge items that were drawn differently
+    linked = set()
+    for feature in features:
+      reachable = self.reachable[feature] - { feature }
+      if reachable & set(self.features) or reachable & linked:
+        return True
+
+      linked |= reachable
+      for trait in self.traits[feature].values():
+        if trait['link:feature'] == feature:
+          return True
+
+    return False
@@ -0,0 +1,80 @@
+
+import io, logging, time
+from PIL import Image, ImageChops
+
+
+class ImageEncoder(object):
+  # format => (Pillow format, extension, default options)
+  FORMATS = {
+    'jpg':  ('JPEG', '.jpg',  {}),
+    'png':  ('PNG',  '.png',  {}),
+    'webp': ('WEBP', '.webp', { 'lossless': True })
+  }
+
+  def __init__(self, format='png', options=None):
+    try:
+      self.format, self.extension, defaults = self.FORMATS[format.lower()]
+    except KeyError:
+      raise NotImplementedError(f"Unsupported output format: '{format}'")
+
+    self.options = dict(defaults)
+    self.options.update(options or {})
+
+    # not a Pillow option: store images with 256 colors or fewer as a palette
+    self.quantize = self.options.pop('quantize', False)
+
+
+  def __str__(self):
+    options = dict(self.options)
+    if self.quantize:
+      options['quantize'] = True
+
+    return f'{self.format} {options}'
+
+
+  def encode(self, image):
+    buffer = io.BytesIO()
+    self.save(image, buffer)
+    return buffer.getvalue()
+
+
+  def prepare(self, image):
+    if self.format == 'JPEG':
+      # jpg doesn't support alpha
+      return image.convert('RGB')
+
+    if self.quantize:
+      colors = image.getcolors(256)
+      if colors:
+        quantized = image.quantize(len(colors), method=Image.Quantize.FASTOCTREE)
+
+        # only keep the palette if it is lossless
+        if ImageChops.difference(quantized.convert(image.mode), image).getbbox() is None:
+          return quantized
+
+    return image
+
+
+  def save(self, image, fp):
+    self.prepare(image).save(fp, self.format, **self.options)
+
+
+
+def benchmark_encoders(images, encoders):
+  results = []
+  for encoder in encoders:
+    nbytes = 0
+    start = time.perf_counter()
+    for image in images:
+      nbytes += len(encoder.encode(image))
+
+    seconds = time.perf_counter() - start
+    results.append((encoder, seconds, nbytes))
+
+
+  count = max(1, len(images))
+  for encoder, seconds, nbytes in results:
+    logging.info('BENCHMARK: {0:8.1f} ms/image {1:10.1f} KB/image  {2}'.format(
+      1000 * seconds / count, nbytes / count / 1024, encoder))
+
+  return results
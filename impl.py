@@ -1,8 +1,21 @@
 
-import csv, datetime, json, logging, os, random, signal, sys, threading
+import csv, datetime, hashlib, itertools, json, logging, os, random, signal, string, sys, threading, time
 import multiprocessing as mp
+from array import array
+from collections import deque
 from queue import Queue
-from PIL import Image
+from PIL import Image, ImageChops
+
+from compositors import COMPOSITORS
+from counters import RecipeCounter
+from encoders import ImageEncoder, benchmark_encoders
+from items import ItemList, ItemStream, ItemTable, TraitCodec
+from layers import Layer, LayerAtlas, LayerCache, LayerStore, get_fingerprint
+from links import LinkGraph
+from pipeline import Pipeline
+from rules import RuleSet
+from samplers import BatchSampler, ConstrainedSampler, TraitSampler, UniqueSampler, get_quotas, get_seed
+from stats import RecipeStats, ScoreSpool
 
 # google sheets
 from googleapiclient import discovery
@@ -25,30 +38,64 @@ class TraitManager(object):
 
     # paths
     self.base_path = __dir__
+    self.metadata_only_path = None
     self.metadata_path = os.path.join(__dir__, '3-metadata')
     self.rules_path = os.path.join(__dir__, 'rules.json')
+    self.stats_path = None
 
     # scalars
+    self.count_only = False
     self.current_item = None
     self.gsheet_id = None
+    self.link_graph = None
+    self.metadata_document = None
+    self.metadata_formatted = []
+    self.metadata_fragments = None
+    self.randomize_procs = 0
 
     # vectors
     self.continue_items = {}
     self.new_items = []
+    self.populations = {}
     self.recipe_items = {}
+    self.rule_set = None
     self.rules = []
+    self.trait_samplers = {}
     self.traits = {}
     self.use_procs = 0
     self.use_threads = 0
+    self.weights = {}
 
     # TODO: self.config
     self.BASE_TRAITS = []
+    self.BENCHMARK_ENCODERS = 0
+    self.CHECK_COMPOSITOR = 0
+    self.COMPACT_ITEMS = False
+    self.COMPOSITOR = 'pillow'
+    self.COUNT_ITEMS = True
+    self.COUNT_LIMIT = 1000000
     self.CREATE_IMAGES = True
     self.CREATE_METADATA = True
+    self.ENCODE_THREADS = 2
+    self.LAYER_CACHE_MB = None
+    self.LAYER_CACHE_PATH = None
     self.LOW_MEM = False
+    self.METADATA_THREADS = 8
+    self.OUTPUT_FORMAT = 'png'
+    self.OUTPUT_OPTIONS = {}
+    self.PIPELINE = False
+    self.PIPELINE_DEPTH = 8
+    self.PREFIX_CACHE_MB = 0
+    self.PROCS_CHUNK = 8
     self.QUANTITY = 0
+    self.RANDOMIZE_BATCH = 10000
     self.RESIZE = None
+    self.RESUME = False
+    self.SAMPLER = 'random'
+    self.SEED = None
+    self.SHARED_ATLAS = False
     self.START_IDX = 0
+    self.STREAM_ITEMS = False
     self.METADATA_FORMAT = {
       "name": "",
       "description": "",
@@ -56,41 +103,35 @@ class TraitManager(object):
     }
 
 
-  def check_distribution(self):
-    raise NotImplementedError()
+  def check_distribution(self, csv_path=None):
+    # two streaming passes (counts, then rarity) over csv_path, or continue_items + new_items
+    codec = TraitCodec(self.traits)
+    stats = RecipeStats(codec, self.traits)
+    for _, rows in self.get_stats_chunks(codec, csv_path):
+      stats.add(rows)
 
-    counts = {}
-    for data in items:
-      for feature, expression in data.items():
-        if feature in counts:
-          try:
-            counts[feature][expression] += 1
-          except KeyError:
-            counts[feature][expression] = 1
-        else:
-          counts[feature] = { expression: 1 }
-
-    for feature, values in counts.items():
-      if feature == 'index':
+    features = stats.get_features()
+    for feature in features:
+      if self.BASE_TRAITS and feature['feature'] not in self.BASE_TRAITS:
         continue
 
+      logging.info("STATS: {0} chi-square {1:.1f} with {2} degrees of freedom".format(feature['feature'], feature['chi_square'], feature['degrees']))
+      for trait in feature['traits']:
+        # 10% margin of error
+        if trait['deviation'] is not None and abs(trait['deviation']) > 0.1:
+          logging.warning("STATS: {0}-{1}: {2} items, {3:.1f} expected ({4:+.1%})".format(
+            feature['feature'], trait['expression'], trait['count'], trait['expected'], trait['deviation']))
 
-      for expression in values:
-        try:
-          trait = self.get_trait(feature, expression)
-          if trait['mils']:
-            pct = counts[feature][expression] / float(trait['mils'])
 
-            # 10% margin of error
-            margin = abs(1 - pct)
-            if margin < 1 and margin > 0.1:
-              logging.warning(f"{feature}-{expression}: {pct}")
-              # TODO: if we throw some out, we should shuffle at the end
+    # scores are sorted on disk in chunks, then merged
+    base = os.path.splitext(csv_path or self.recipe_path or os.path.join(self.base_path, 'recipe.csv'))[0]
+    with ScoreSpool(os.path.dirname(base)) as spool:
+      for indexes, rows in self.get_stats_chunks(codec, csv_path):
+        spool.add(indexes, stats.get_scores(rows))
 
-        except Exception as ex:
-          logging.info(f"feature: {feature} expression: {expression}")
-          logging.exception(ex)
-          raise ex
+      self.write_stats(base, stats.total, features, spool.get_ranks())
+
+    return features
 
 
   def close_recipes(self):
@@ -100,6 +141,10 @@ class TraitManager(object):
       self.recipe_fd = None
 
 
+  def close_stream(self):
+    self.close_recipes()
+
+
   def compile_base_traits(self):
     weights = {}
     populations = {}
@@ -125,12 +170,109 @@ class TraitManager(object):
     return (weights, populations)
 
 
+  def compile_links(self):
+    self.link_graph = LinkGraph(self.traits, self.get_trait_sampler)
+
+
+  def compile_metadata(self):
+    # feature => expression => the JSON of its attribute (None if it isn't metadata)
+    self.metadata_fragments = {}
+
+    # the JSON of METADATA_FORMAT as one format string: {0} is the index, {1} the attributes,
+    # and {2}... the templates that still need str.format(), in metadata_formatted order
+    self.metadata_document = None
+    self.metadata_formatted = []
+
+    # customized metadata keeps the get_metadata() path
+    if type(self).finalize_traits is not TraitManager.finalize_traits or type(self).get_metadata is not TraitManager.get_metadata:
+      return
+
+    for feature, expressions in self.traits.items():
+      fragments = self.metadata_fragments[feature] = {}
+      for expression, trait in expressions.items():
+        if not trait['is_metadata']:
+          fragments[expression] = None
+
+        elif trait['display_type'] == 'string':
+          fragments[expression] = json.dumps({ "trait_type": trait['trait_type'], "value": trait['value'] })
+
+        elif trait['display_type'] == 'number':
+          try:
+            fragments[expression] = json.dumps({ "trait_type": trait['trait_type'], "value": int(trait['value']) })
+          except ValueError:
+            pass
+
+        # anything else fails in finalize_traits() when an item uses it
+
+
+    fields = []
+    for key, value in self.METADATA_FORMAT.items():
+      if key == 'attributes':
+        continue
+
+      template = self.compile_template(value)
+      if template is None:
+        template = '{{{0}}}'.format(2 + len(self.metadata_formatted))
+        self.metadata_formatted.append(key)
+
+      fields.append('{0}: {1}'.format(self.escape_format(json.dumps(key)), template))
+
+    # 'attributes' keeps its place if METADATA_FORMAT has one
+    fields.insert(list(self.METADATA_FORMAT).index('attributes') if 'attributes' in self.METADATA_FORMAT else len(fields), '"attributes": [{1}]')
+    self.metadata_document = '{{' + ', '.join(fields) + '}}'
+
+
+  @staticmethod
+  def compile_template(template):
+    # a JSON string as a format string with {0} for the index, or None if the template needs str.format()
+    parts = []
+    try:
+      for literal, field, spec, conversion in string.Formatter().parse(template):
+        if literal:
+          parts.append(TraitManager.escape_format(json.dumps(literal)[1:-1]))
+
+        if field is not None:
+          if field != 'index' or spec or conversion:
+            return None
+
+          parts.append('{0}')
+
+    except (AttributeError, TypeError, ValueError):
+      return None
+
+    return '"' + ''.join(parts) + '"'
+
+
+  def compile_trait_samplers(self):
+    self.trait_samplers = {}
+    for feature in self.traits:
+      self.get_trait_sampler(feature)
+
+
+  def count_items(self):
+    if self.rule_set is None:
+      self.validate_rules()
+
+    if not self.populations:
+      self.weights, self.populations = self.compile_base_traits()
+
+    counter = RecipeCounter(self.weights, self.populations, self.traits, self.rule_set, self.COUNT_LIMIT)
+    count, probability, margin = counter.count()
+    if margin:
+      logging.info(f"COUNT: ~{count} ± {margin} valid unique items (estimated)")
+    else:
+      logging.info(f"COUNT: {count} valid unique items")
+
+    logging.info(f"COUNT: {probability:.2%} of random draws are valid, {1 - probability:.2%} expected rejection rate")
+    return (count, probability, margin)
+
+
   def configure(self):
     args = sys.argv.copy()
     args.pop(0)
 
     for arg in args:
-      key, value = arg.split('=')
+      key, _, value = arg.partition('=')
       if key == '--config':
         # TODO: is path rooted?
         logging.info(value)
@@ -146,10 +288,18 @@ class TraitManager(object):
     
 
     for arg in args:
-      key, value = arg.split('=')
+      key, _, value = arg.partition('=')
       if key == '--config':
         pass
 
+      elif key == '--benchmark-encoders':
+        logging.info('CONFIGURE: Benchmarking encoders with {0} items'.format(value))
+        self.BENCHMARK_ENCODERS = int(value)
+
+      elif key == '--check-compositor':
+        logging.info('CONFIGURE: Checking the compositor with {0} items'.format(value))
+        self.CHECK_COMPOSITOR = int(value)
+
       elif key == '--continue':
         # TODO: is path rooted?
         if value[0] == '/':
@@ -160,6 +310,10 @@ class TraitManager(object):
         logging.info('CONFIGURE: Continuing recipes from {0}'.format(csv_path))
         self.continue_items = self.load_items(csv_path)
 
+      elif key == '--count':
+        logging.info('CONFIGURE: Counting valid items only')
+        self.count_only = True
+
       elif key == '--level':
         logging.info('CONFIGURE: Change log level {0}'.format(value))
         value = value.upper()
@@ -167,10 +321,27 @@ class TraitManager(object):
         logger = logging.getLogger()
         logger.setLevel(value)
 
+      elif key == '--metadata-only':
+        # TODO: is path rooted?
+        if value[0] == '/':
+          self.metadata_only_path = value
+        else:
+          self.metadata_only_path = os.path.join(self.base_path, value)
+
+        logging.info('CONFIGURE: Rewriting the metadata of {0}'.format(self.metadata_only_path))
+
+      elif key == '--procs':
+        logging.info('CONFIGURE: Using {0} processes'.format(value))
+        self.use_procs = int(value)
+
       elif key == '--quantity':
         logging.info('CONFIGURE: Overriding quantity from {0} to {1}'.format(self.QUANTITY, value))
         self.QUANTITY = int(value)
 
+      elif key == '--randomize-procs':
+        logging.info('CONFIGURE: Randomizing in {0} processes'.format(value))
+        self.randomize_procs = int(value)
+
       elif key == '--recipes':
         # TODO: is path rooted?
         if value[0] == '/':
@@ -181,6 +352,19 @@ class TraitManager(object):
         logging.info('CONFIGURE: Blending recipes from {0}'.format(value))
         self.recipe_items = self.load_items(csv_path)
 
+      elif key == '--resume':
+        logging.info('CONFIGURE: Resuming images from the manifest')
+        self.RESUME = value.lower() not in ('0', 'false', 'no')
+
+      elif key == '--stats':
+        # TODO: is path rooted?
+        if value[0] == '/':
+          self.stats_path = value
+        else:
+          self.stats_path = os.path.join(self.base_path, value)
+
+        logging.info('CONFIGURE: Checking the distribution of {0}'.format(self.stats_path))
+
       elif key == '--threads':
         logging.info('CONFIGURE: Using {0} threads'.format(value))
         self.use_threads = int(value)
@@ -190,11 +374,7 @@ class TraitManager(object):
 
 
   def customize(self):
-    for rule in self.rules:
-      if 'hits' not in rule or not rule['hits']:
-        logging.error('Rule was not used')
-        logging.error(rule)
-        #raise Exception("Rule was not used")
+    self.rule_set.report()
 
     '''
     TODO
@@ -204,16 +384,10 @@ class TraitManager(object):
     '''
 
 
-    i = 0
-    for item in self.continue_items:
-      item['index'] = i
-      i += 1
-
+    self.continue_items.set_indexes(0)
 
     #extra = []
-    for item in self.new_items:
-      item['index'] = i
-      i += 1
+    self.new_items.set_indexes(len(self.continue_items))
 
 
   @staticmethod
@@ -230,6 +404,11 @@ class TraitManager(object):
     logger.addHandler(handler)
 
 
+  @staticmethod
+  def escape_format(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+
   def finalize_traits(self, item):
     #TODO: add custom/derived traits here
     json_traits = item.copy()
@@ -270,21 +449,10 @@ class TraitManager(object):
 
 
   def generate_items(self):
-    gen_items = []
-    all_items = [*self.continue_items, *self.new_items]
-    for idx in range(self.START_IDX, len(all_items)):
-      gen_items.append(all_items[idx])
-
-
-    columns = list(self.traits.keys())
-    columns.insert(0, 'index')
+    gen_items = self.get_items(self.START_IDX)
 
-    # TODO: open_recipes()
-    self.recipe_fd = open(self.recipe_path, 'w', newline='\n')
-    self.recipe_csv = csv.DictWriter(self.recipe_fd, columns)
-    self.recipe_csv.writeheader()
 
-    
+    self.open_recipes()
     for item in gen_items:
       try:
         self.recipe_csv.writerow(item)
@@ -296,20 +464,170 @@ class TraitManager(object):
 
 
     if self.CREATE_METADATA:
-      for item in gen_items:
+      for item in self.get_items(self.START_IDX):
         self.generate_json(item)
 
 
+  def generate_metadata(self, csv_path, batch=1000):
+    # rewrites the JSON of every item in a recipe CSV, without randomizing or checking rules
+    self.compile_metadata()
+
+    lock = threading.Lock()
+    written = [0]
+
+    def format_batch(items):
+      return [(os.path.join(self.metadata_path, '{0}.json'.format(item['index'])), self.get_json(item).encode()) for item in items]
+
+    def write_batch(files):
+      for save_as, data in files:
+        with open(save_as, 'wb') as fd:
+          fd.write(data)
+
+      with lock:
+        written[0] += len(files)
+
+
+    pipeline = Pipeline()
+    pipeline.add('format', format_batch, 1, 4)
+    pipeline.add('write', write_batch, self.METADATA_THREADS, 2 * self.METADATA_THREADS)
+    pipeline.start()
+
+    start = time.perf_counter()
+    total = 0
+    try:
+      with open(csv_path, newline='') as fd:
+        items = []
+        for row in csv.DictReader(fd):
+          # features an item doesn't have are empty
+          item = { key: value for key, value in row.items() if value }
+          if int(item['index']) < self.START_IDX:
+            continue
+
+          items.append(item)
+          if len(items) == batch:
+            pipeline.put(items)
+            total += len(items)
+            items = []
+
+        if items:
+          pipeline.put(items)
+          total += len(items)
+
+    finally:
+      pipeline.join()
+      pipeline.report()
+
+    elapsed = time.perf_counter() - start
+    logging.info("METADATA: {0} files in {1:.1f}s, {2:.0f} files/sec".format(written[0], elapsed, written[0] / elapsed if elapsed else 0))
+    if written[0] < total:
+      raise Exception(f"METADATA: {total - written[0]} of {total} files failed")
+
+    return written[0]
+
+
   def generate_json(self, item):
+    save_as = os.path.join(self.metadata_path, '{0}.json'.format(item['index']))
+    with open(save_as, 'w') as fp:
+      fp.write(self.get_json(item))
+
+
+  def get_config(self):
+    config = {key: value for key, value in vars(self).items() if key.isupper()}
+    config['base_path'] = self.base_path
+    config['metadata_path'] = self.metadata_path
+    return config
+
+
+  def get_items(self, start=0):
+    # continue_items then new_items; compact items are materialized one at a time
+    return itertools.islice(itertools.chain(self.continue_items, self.new_items), start, None)
+
+
+  def get_json(self, item):
+    # the text json.dump() writes for get_metadata(), joined from compile_metadata()'s fragments
+    if self.metadata_fragments is None:
+      self.compile_metadata()
+
+    if not self.metadata_document or 'index' not in item:
+      return json.dumps(self.get_metadata(item))
+
+    attributes = []
+    for feature, expression in item.items():
+      if feature == 'index':
+        continue
+
+      try:
+        fragment = self.metadata_fragments[feature][expression]
+      except KeyError:
+        # unknown traits and unsupported display types raise there
+        return json.dumps(self.get_metadata(item))
+
+      if fragment:
+        attributes.append(fragment)
+
+    index = item['index']
+    formatted = [json.dumps(self.METADATA_FORMAT[key].format(index=index)) for key in self.metadata_formatted]
+    index = str(index) if type(index) is int else json.dumps(str(index))[1:-1]
+    return self.metadata_document.format(index, ', '.join(attributes), *formatted)
+
+
+  def get_metadata(self, item):
     #TODO: offset
     data = {}
     for key, value in self.METADATA_FORMAT.items():
       data[key] = value.format(index=item['index'])
 
     data['attributes'] = self.finalize_traits(item)
-    save_as = os.path.join(self.metadata_path, '{0}.json'.format(item['index']))
-    with open(save_as, 'w') as fp:
-      json.dump(data, fp)
+    return data
+
+
+  def get_rng(self, stream):
+    # an independent stream per shard of candidates, or the global one without a SEED
+    if self.SEED is None:
+      return random
+
+    return random.Random(get_seed(self.SEED, stream))
+
+
+  def get_shard_size(self):
+    # only depends on the config, so a SEED gives the same shards in any process
+    return min(self.RANDOMIZE_BATCH, max(64, 2 * self.QUANTITY))
+
+
+  def get_stats_chunks(self, codec, csv_path=None, size=65536):
+    # (indexes, rows of trait codes) in chunks, so recipe files of any size fit in memory
+    if csv_path:
+      fd = open(csv_path, newline='')
+      items = csv.DictReader(fd)
+    else:
+      fd = None
+      items = self.get_items()
+
+    try:
+      indexes = array('q')
+      rows = array(codec.typecode)
+      for i, item in enumerate(items):
+        row = codec.encode(item)
+        if row is None:
+          raise Exception(f"Row {i}: traits that aren't in traits.csv: {item}")
+
+        try:
+          indexes.append(int(item.get('index', i)))
+        except ValueError:
+          indexes.append(i)
+
+        rows.extend(row)
+        if len(indexes) == size:
+          yield (indexes, rows)
+          indexes = array('q')
+          rows = array(codec.typecode)
+
+      if indexes:
+        yield (indexes, rows)
+
+    finally:
+      if fd:
+        fd.close()
 
 
   def get_trait(self, feature, expression):
@@ -320,6 +638,27 @@ class TraitManager(object):
       raise kex
 
 
+  def get_trait_sampler(self, feature, **kwargs):
+    # built once per feature and filter
+    cache_key = (feature, tuple(sorted(kwargs.items())))
+    try:
+      return self.trait_samplers[cache_key]
+    except KeyError:
+      pass
+
+    traits = [trait for trait in self.traits[feature].values()]
+
+    if kwargs:
+      for key, value in kwargs.items():
+        traits = [trait for trait in traits if trait[key] == value]
+        if not traits:
+          logging.warning(f"No traits found for {feature} :: '{key}'='{value}'")
+
+    sampler = TraitSampler([trait['expression'] for trait in traits], [trait['mils'] for trait in traits])
+    self.trait_samplers[cache_key] = sampler
+    return sampler
+
+
   def get_traits(self, feature, **kwargs):
     traits = [trait for trait in self.traits[feature].values()]
 
@@ -337,6 +676,13 @@ class TraitManager(object):
     return selected.values()
 
 
+  def has_random_links(self):
+    if self.link_graph is None:
+      self.compile_links()
+
+    return self.link_graph.has_random
+
+
   def init(self):
     try:
       self.metadata_path = os.path.join(self.base_path, '3-metadata')
@@ -379,7 +725,7 @@ class TraitManager(object):
 
   @staticmethod
   def is_item_match(item, match):
-    if TraitGenerator.is_match_enabled(match):
+    if TraitManager.is_match_enabled(match):
       if match['feature'] in item and item[match['feature']]:
         expression = item[match['feature']]
         if 'is_any' in match and match['is_any']:
@@ -392,37 +738,10 @@ class TraitManager(object):
 
 
   def is_item_valid(self, item, throw=False):
-    self.validate_rules()
-
-    for rule in self.rules:
-      if not self.is_rule_enabled(rule):
-        continue
-
-      if not self.is_item_match(item, rule['match']):
-        continue
-
-      if rule['type'] == 'allow':
-        if not self.is_item_allowed(item, rule):
-          if throw:
-            raise Exception(rule)
-          else:
-            return False
-
-      elif rule['type'] == 'deny':
-        if self.is_item_denied(item, rule):
-          if throw:
-            raise Exception(rule)
-          else:
-            return False
-
-      elif rule['type'] == 'info':
-        #ignore this
-        pass
-
-      else:
-        raise Exception("Unsupported rule type: {0}".format(rule['type']))
+    if self.rule_set is None:
+      self.validate_rules()
 
-    return True
+    return self.rule_set.is_valid(item, throw)
 
 
   @staticmethod
@@ -554,6 +873,9 @@ class TraitManager(object):
     if all_paths_ok:
       logging.info(sorted(traits.keys()))
       self.traits = traits
+      self.compile_trait_samplers()
+      self.compile_links()
+      self.compile_metadata()
 
     else:
       raise Exception("Missing resources")
@@ -587,7 +909,7 @@ class TraitManager(object):
 
     # TODO: is path rooted?
     traits_path = os.path.join(self.base_path, "traits.csv")
-    with open(path) as fd:
+    with open(traits_path) as fd:
       i = 0
       reader = csv.DictReader(fd)
       for row in reader:
@@ -648,163 +970,627 @@ class TraitManager(object):
     if all_paths_ok:
       logging.info(sorted(traits.keys()))
       self.traits = traits
+      self.compile_trait_samplers()
+      self.compile_links()
+      self.compile_metadata()
 
     else:
       raise Exception("Missing resources")
 
 
-  def process_links(self, item):
-    modified = False
-    source = item.copy()
-    for key, value in source.items():
-      while key:
-        trait = self.get_trait(key, value)
-        key = trait['link:feature']
-        if key:
-          if trait['link:expression'] == '*':
-            value = self.randomize_trait(key)
-          else:
-            value = trait['link:expression']
+  def open_recipes(self):
+    columns = list(self.traits.keys())
+    columns.insert(0, 'index')
 
-          #logging.info('{0} :: {1}'.format(key, value))
-          item[key] = value
-          modified = True
+    self.recipe_fd = open(self.recipe_path, 'w', newline='\n')
+    self.recipe_csv = csv.DictWriter(self.recipe_fd, columns)
+    self.recipe_csv.writeheader()
 
-        else:
-          break
 
-    return modified
+  def open_stream(self):
+    # continue_items are written first, then stream_item() writes each new item as it is accepted
+    self.open_recipes()
+    for item in self.get_items(self.START_IDX):
+      self.stream_item(item)
+
+
+  def process_links(self, item, rng=random):
+    if self.link_graph is None:
+      self.compile_links()
+
+    return self.link_graph.resolve(item, rng)
 
 
   def randomize(self):
-    i = 0
-    quantity = self.QUANTITY
-    if self.continue_items:
-      i += len(self.continue_items) - 1
-      quantity -= len(self.continue_items)
+    if self.SEED is not None:
+      random.seed(self.SEED)
 
+    if self.COMPACT_ITEMS or self.STREAM_ITEMS:
+      codec = TraitCodec(self.traits)
+      self.continue_items = ItemTable(codec, self.continue_items.values())
+    else:
+      self.continue_items = ItemList(self.continue_items.values())
+
+    if self.STREAM_ITEMS:
+      # new items go straight to the recipes, metadata and images
+      self.continue_items.set_indexes(0)
+      self.new_items = []
+      self.open_stream()
+      new_items = ItemStream(codec, self.stream_item, len(self.continue_items))
+    elif self.COMPACT_ITEMS:
+      new_items = ItemTable(codec)
+    else:
+      new_items = ItemList()
 
-    new_items = {}
-    if self.recipe_items:
-      new_items.update(self.recipe_items)
-      quantity -= len(new_items)
+    try:
+      self.randomize_new_items(new_items)
+    finally:
+      if self.STREAM_ITEMS:
+        self.close_stream()
+
+    # numbered continue_items first, like the streamed items
+    self.new_items = new_items
+    self.continue_items.set_indexes(0)
+    self.new_items.set_indexes(len(self.continue_items))
+    if self.new_items:
+      logging.info("{0} random items".format(len(self.new_items) ))
+    else:
+      logging.warning("{0} random items".format(len(self.new_items) ))
+    
+    if self.rule_set:
+      self.rule_set.report()
 
-      #break the ref
-      self.recipe_items = {}
+    # extra shuffle
+    #new_items = random.sample(new_items, k=len(new_items))
+
+    return self.new_items
 
 
-    duplicate = 0
+  def randomize_batches(self, new_items, quantity):
+    sampler = BatchSampler(self.weights, self.populations)
+
+    # identical base traits only produce identical items if no link is random
+    seen = None
+    if not self.has_random_links():
+      seen = set(sampler.encode(item) for item in [*self.continue_items, *new_items])
+      seen.discard(None)
+
+    accepted = 0
+    batch = 0
+    drawn = 0
     invalid = 0
-    self.weights, self.populations = self.compile_base_traits()
+    stale = 0
+    stale_invalid = 0
     while quantity > 0:
-      i += 1
-      if duplicate > 10000:
+      if stale > 10000:
         logging.warning(f"Remaining {quantity}")
-        raise Exception("Too many duplicate items")
+        if stale_invalid > stale // 2:
+          raise Exception("Too many invalid items")
+        else:
+          raise Exception("Too many duplicate items")
 
-      if invalid > 10000:
-        logging.warning(f"Remaining {quantity}")
-        raise Exception("Too many invalid items")
 
+      count = min(self.RANDOMIZE_BATCH, max(64, 2 * quantity))
+      if self.SEED is None:
+        keys = sampler.sample(count)
+        rng = random
+      else:
+        keys = sampler.sample(count, sampler.get_rng(get_seed(self.SEED, batch)))
+        rng = self.get_rng(batch)
 
-      item = {}
-      for feature in self.weights.keys():
-        selected, = random.choices(self.populations[feature], weights=self.weights[feature])
-        item[feature] = selected
+      batch += 1
+      drawn += count
 
+      batch_accepted = 0
+      batch_invalid = 0
+      for code in keys:
+        if seen is not None:
+          if code in seen:
+            continue
 
-      self.randomize_extended_traits(item, i)   
-      if self.is_rule_valid(item):
-        #TODO: ignore layers
-        #key = item.copy()
-        #del key['Background']
+          seen.add(code)
 
-        key = tuple(sorted(item.items()))
-        if key in self.continue_items or key in new_items:
-          duplicate += 1
+        item = sampler.decode(code)
+        self.process_links(item, rng)
+        if not self.is_item_valid(item):
+          batch_invalid += 1
+          continue
 
-        else:
-          quantity -= 1
-          new_items[key] = item
+        if item in self.continue_items or not new_items.add(item):
+          continue
 
-      else:
-        invalid += 1
+        batch_accepted += 1
+        quantity -= 1
+        if not quantity:
+          break
 
-    # flatten
-    self.continue_items = self.continue_items.values()
-    self.new_items = list(new_items.values())
-    if self.new_items:
-      logging.info("{0} random items".format(len(self.new_items) ))
-    else:
-      logging.warning("{0} random items".format(len(self.new_items) ))
-    
-    # extra shuffle
-    #new_items = random.sample(new_items, k=len(new_items))
 
-    return self.new_items
+      accepted += batch_accepted
+      invalid += batch_invalid
+      if batch_accepted:
+        stale = 0
+        stale_invalid = 0
+      else:
+        stale += count
+        stale_invalid += batch_invalid
 
 
-  def randomize_extended_traits(self, item, i):
-    logging.info("Processing item {0}".format(i))
-    self.process_links(item)
+    logging.info(f"BATCH: {drawn} candidates, {accepted} accepted, {invalid} invalid, {drawn - accepted - invalid} duplicate")
 
 
-  def randomize_last(self):
-    pass
+  def randomize_constrained(self, new_items, quantity):
+    if self.rule_set is None:
+      self.validate_rules()
 
+    sampler = ConstrainedSampler(self.weights, self.populations, self.rule_set)
+    rng = self.get_rng(0)
 
-  def randomize_trait(self, feature, **kwargs):
-    traits = [trait for trait in self.traits[feature].values()]
+    accepted = 0
+    dead_ends = 0
+    duplicate = 0
+    invalid = 0
+    stale = 0
+    stale_dead_ends = 0
+    stale_invalid = 0
+    while quantity > 0:
+      if stale > 10000:
+        logging.warning(f"Remaining {quantity}")
+        if stale_dead_ends > stale // 2:
+          raise Exception("Rules leave no weight for {0}".format(sorted(sampler.dead_ends.keys())))
+        elif stale_invalid > stale // 2:
+          raise Exception("Too many invalid items")
+        else:
+          raise Exception("Too many duplicate items")
 
-    if kwargs:
-      for key, value in kwargs.items():
-        traits = [trait for trait in traits if trait[key] == value]
-        if not traits:
-          logging.warning(f"No traits found for {feature} :: '{key}'='{value}'")
 
-    if len(traits) > 1:
-      return self.randomize_traits(traits)
-    elif len(traits) == 1:
-      return traits[0]['expression']
-    else:
-      return ''
+      stale += 1
+      code = sampler.draw(rng)
+      if code is None:
+        dead_ends += 1
+        stale_dead_ends += 1
+        continue
 
+      # linked features aren't drawn by the sampler, so they still need checking
+      item = sampler.decode(code)
+      self.process_links(item, rng)
+      if not self.is_item_valid(item):
+        invalid += 1
+        stale_invalid += 1
+        continue
 
-  @staticmethod
-  def randomize_values(values, weights):
-    selected, = random.choices(values, weights=weights)
-    return selected
+      if item in self.continue_items or not new_items.add(item):
+        duplicate += 1
+        continue
 
+      accepted += 1
+      quantity -= 1
+      stale = 0
+      stale_dead_ends = 0
+      stale_invalid = 0
 
-  def randomize_traits(self, traits):
-    population = tuple([t['expression'] for t in traits])
-    weights = tuple([t['mils'] for t in traits])
-    if len(set(weights)) == 1:
-      weights = None
+    logging.info(f"CONSTRAINED: {accepted} accepted, {invalid} invalid, {duplicate} duplicate, {dead_ends} dead ends")
+    for feature, count in sampler.dead_ends.items():
+      logging.warning(f"CONSTRAINED: rules left no weight for '{feature}' {count} times")
 
-    #logging.info(weights)
-    #logging.info(population)
-    selected, = random.choices(population, weights=weights)
-    return selected
 
+  def randomize_candidates(self, samplers, shard, i):
+    # yields one shard of candidates from its own stream; i is the first candidate's number
+    rng = self.get_rng(shard)
+    for i in range(i, i + self.get_shard_size()):
+      item = {}
+      for feature, sampler in samplers:
+        item[feature] = sampler.sample(rng)
 
-  def validate_rule(self, rule):
-    #logging.info(rule)
+      self.randomize_extended_traits(item, i, rng)
+      yield item
 
-    #check the match
-    feature = rule['match']['feature']
-    if rule['match']['is_any']:
-      self.traits[feature]
 
-    else:
-      for expression in rule['match']['expressions']:
-        self.get_trait(feature, expression)
+  def randomize_extended_traits(self, item, i, rng=random):
+    logging.debug("Processing item {0}".format(i))
+    self.process_links(item, rng)
 
 
-    for allowed in rule['allowed']:
-      feature = allowed['feature']
-      if allowed['is_any']:
-        self.traits[feature]
+  def randomize_items(self, new_items, quantity, i):
+    samplers = [(feature, TraitSampler(self.populations[feature], self.weights[feature] or ())) for feature in self.weights]
+
+    duplicate = 0
+    invalid = 0
+    shard = 0
+    stale = 0
+    stale_invalid = 0
+    while quantity > 0:
+      # the same shards, in the same order, for a given SEED
+      candidates = self.randomize_candidates(samplers, shard, i + 1)
+      shard += 1
+
+      for item in candidates:
+        i += 1
+        # only a run of rejects since the last accepted item fails, however large QUANTITY is
+        if stale > 10000:
+          logging.warning(f"Remaining {quantity}")
+          if stale_invalid > stale // 2:
+            raise Exception("Too many invalid items")
+          else:
+            raise Exception("Too many duplicate items")
+
+
+        if self.is_item_valid(item):
+          #TODO: ignore layers
+          #key = item.copy()
+          #del key['Background']
+
+          if item in self.continue_items or not new_items.add(item):
+            duplicate += 1
+            stale += 1
+
+          else:
+            quantity -= 1
+            stale = 0
+            stale_invalid = 0
+            if not quantity:
+              break
+
+        else:
+          invalid += 1
+          stale += 1
+          stale_invalid += 1
+
+    logging.info(f"RANDOMIZE: {invalid} invalid, {duplicate} duplicate")
+
+
+  def randomize_items_procs(self, new_items, quantity, i):
+    # workers draw whole shards; merging them in shard order gives the same items as one process
+    codec = TraitCodec(self.traits)
+    config = self.get_config()
+    if self.SEED is None:
+      config['SEED'] = random.getrandbits(64)
+
+    duplicate = 0
+    invalid = 0
+    shard = 0
+    stale = 0
+    stale_invalid = 0
+    start = i + 1
+    initargs = (type(self), config, self.traits, self.weights, self.populations)
+    with mp.Pool(self.randomize_procs, _init_randomizer, initargs) as pool:
+      pending = deque()
+      while quantity > 0:
+        while len(pending) < 2 * self.randomize_procs:
+          pending.append(pool.apply_async(_randomize_shard, (shard, start + shard * self.get_shard_size())))
+          shard += 1
+
+        rows = pending.popleft().get()
+        for offset in range(0, len(rows), codec.width):
+          i += 1
+          # only a run of rejects since the last accepted item fails, however large QUANTITY is
+          if stale > 10000:
+            logging.warning(f"Remaining {quantity}")
+            if stale_invalid > stale // 2:
+              raise Exception("Too many invalid items")
+            else:
+              raise Exception("Too many duplicate items")
+
+
+          item = codec.decode(rows[offset:offset + codec.width])
+          if self.is_item_valid(item):
+            if item in self.continue_items or not new_items.add(item):
+              duplicate += 1
+              stale += 1
+
+            else:
+              quantity -= 1
+              stale = 0
+              stale_invalid = 0
+              if not quantity:
+                break
+
+          else:
+            invalid += 1
+            stale += 1
+            stale_invalid += 1
+
+      pool.terminate()
+
+    logging.info(f"RANDOMIZE: {shard} shards drawn in {self.randomize_procs} processes, {invalid} invalid, {duplicate} duplicate")
+
+
+  def randomize_last(self):
+    pass
+
+
+  def randomize_new_items(self, new_items):
+    i = 0
+    quantity = self.QUANTITY
+    if self.continue_items:
+      i += len(self.continue_items) - 1
+      quantity -= len(self.continue_items)
+
+
+    if self.recipe_items:
+      new_items.extend(self.recipe_items.values())
+      quantity -= len(new_items)
+
+      #break the ref
+      self.recipe_items = {}
+
+
+    self.weights, self.populations = self.compile_base_traits()
+    if self.COUNT_ITEMS:
+      count, _, margin = self.count_items()
+      if self.QUANTITY > count + margin:
+        raise Exception(f"QUANTITY {self.QUANTITY} exceeds the {count} valid unique items")
+
+    if self.SAMPLER == 'batch':
+      self.randomize_batches(new_items, quantity)
+
+    elif self.SAMPLER == 'constrained':
+      self.randomize_constrained(new_items, quantity)
+
+    elif self.SAMPLER == 'quota':
+      self.randomize_quota(new_items, quantity)
+
+    elif self.SAMPLER == 'random':
+      if self.randomize_procs:
+        self.randomize_items_procs(new_items, quantity, i)
+      else:
+        self.randomize_items(new_items, quantity, i)
+
+    elif self.SAMPLER == 'unique':
+      self.randomize_unique(new_items, quantity)
+
+    else:
+      raise NotImplementedError(f"Unsupported sampler: '{self.SAMPLER}'")
+
+    if self.randomize_procs and self.SAMPLER != 'random':
+      logging.warning(f"--randomize-procs only applies to SAMPLER 'random', not '{self.SAMPLER}'")
+
+
+  def randomize_quota(self, new_items, quantity):
+    # exact counts per expression, drawn from per-feature urns, then repaired by swapping one feature between two items
+    if quantity <= 0:
+      return
+
+    if self.rule_set is None:
+      self.validate_rules()
+
+    rng = self.get_rng(0)
+    sampler = ConstrainedSampler(self.weights, self.populations, self.rule_set)
+    features = sampler.features
+
+    # the quotas cover QUANTITY, less what continue_items and recipes already use
+    taken = set(ItemList.get_key(item) for item in [*self.continue_items, *new_items])
+    urns = []
+    for depth, feature in enumerate(features):
+      existing = [0] * len(sampler.populations[depth])
+      for item in [*self.continue_items, *new_items]:
+        code = sampler.codes[depth].get(item.get(feature))
+        if code is not None:
+          existing[code] += 1
+
+      targets = get_quotas(sampler.weights[depth], self.QUANTITY)
+      missing = [max(0, target - count) for target, count in zip(targets, existing)]
+      if sum(missing) != quantity:
+        missing = get_quotas(missing, quantity)
+
+      urns.append(missing)
+
+
+    # constrained shuffle: each feature is drawn from what is left in its urn, among the expressions the rules allow
+    columns = [[None] * quantity for _ in features]
+    items = [None] * quantity
+    keys = [None] * quantity
+    counts = {}
+    for j in range(quantity):
+      for attempt in range(10):
+        item = {}
+        decided = set()
+        prefix = 0
+        codes = []
+        for depth, feature in enumerate(features):
+          decided.add(feature)
+          allowed, _ = sampler.get_allowed(depth, prefix, item, decided)
+          urn = urns[depth]
+          weights = [urn[code] for code in allowed]
+          if not any(weights):
+            # a dead end, left for the repair
+            allowed, weights = range(len(urn)), urn
+
+          code, = rng.choices(allowed, weights=weights)
+          item[feature] = sampler.populations[depth][code]
+          prefix += code * sampler.strides[depth]
+          codes.append(code)
+
+        self.process_links(item, rng)
+        key = ItemList.get_key(item)
+        if key not in taken and key not in counts:
+          break
+
+      for depth, code in enumerate(codes):
+        urns[depth][code] -= 1
+        columns[depth][j] = code
+
+      items[j] = item
+      keys[j] = key
+      counts[key] = counts.get(key, 0) + 1
+
+
+    def build(j):
+      item = { feature: sampler.populations[depth][columns[depth][j]] for depth, feature in enumerate(features) }
+      self.process_links(item, rng)
+      return item
+
+    def get_score(j):
+      # 0 for a valid, unique item
+      score = len(self.rule_set.get_violations(items[j]))
+      if counts[keys[j]] > 1 or keys[j] in taken:
+        score += 1
+
+      return score
+
+    def replace(j, item, key=None):
+      counts[keys[j]] -= 1
+      key = key or ItemList.get_key(item)
+      items[j] = item
+      keys[j] = key
+      counts[key] = counts.get(key, 0) + 1
+
+
+    bad = deque(j for j in range(quantity) if get_score(j))
+    queued = set(bad)
+    initial = len(bad)
+    attempts = 0
+    swaps = 0
+    limit = 1000 * (initial + 1)
+    while bad:
+      j = bad.popleft()
+      queued.discard(j)
+      score = get_score(j)
+      if not score:
+        continue
+
+      if attempts > limit:
+        logging.warning(f"Remaining {len(bad) + 1}")
+        broken = {}
+        duplicate = 0
+        for j in [j, *bad]:
+          for rule_id in self.rule_set.get_violations(items[j]):
+            broken[rule_id] = broken.get(rule_id, 0) + 1
+
+          if counts[keys[j]] > 1 or keys[j] in taken:
+            duplicate += 1
+
+        if duplicate:
+          logging.warning(f"QUOTA: {duplicate} items are duplicates")
+
+        for rule_id, count in broken.items():
+          description = self.rules[rule_id].get('description', rule_id)
+          logging.warning(f"QUOTA: {count} items break {description}")
+
+        raise Exception("Quotas can't satisfy the rules with unique items, {0} items left".format(len(bad) + 1))
+
+      # swap one feature with another item, unless that makes the pair worse
+      for _ in range(100):
+        attempts += 1
+        k = rng.randrange(quantity)
+        depth = rng.randrange(len(features))
+        column = columns[depth]
+        if k == j or column[j] == column[k]:
+          continue
+
+        before = (items[j], keys[j], items[k], keys[k], score + get_score(k))
+        column[j], column[k] = column[k], column[j]
+        replace(j, build(j))
+        replace(k, build(k))
+        after = (get_score(j), get_score(k))
+        if sum(after) <= before[4]:
+          swaps += 1
+          if after[1] and k not in queued:
+            queued.add(k)
+            bad.append(k)
+
+          score = after[0]
+          if not score:
+            break
+
+          continue
+
+        column[j], column[k] = column[k], column[j]
+        replace(j, before[0], before[1])
+        replace(k, before[2], before[3])
+
+      if score:
+        queued.add(j)
+        bad.append(j)
+
+
+    for item in items:
+      # repaired items are valid; this only records the rule hits for report()
+      self.is_item_valid(item)
+      new_items.add(item)
+
+    logging.info(f"QUOTA: {quantity} items, {initial} repaired with {swaps} swaps in {attempts} attempts")
+
+
+  def randomize_trait(self, feature, **kwargs):
+    return self.get_trait_sampler(feature, **kwargs).sample()
+
+
+  @staticmethod
+  def randomize_values(values, weights):
+    selected, = random.choices(values, weights=weights)
+    return selected
+
+
+  def randomize_traits(self, traits):
+    population = tuple([t['expression'] for t in traits])
+    weights = tuple([t['mils'] for t in traits])
+    return TraitSampler(population, weights).sample()
+
+
+  def randomize_unique(self, new_items, quantity):
+    sampler = UniqueSampler(self.weights, self.populations)
+    for item in [*self.continue_items, *new_items]:
+      sampler.exclude(sampler.encode(item))
+
+    if quantity > sampler.remaining:
+      raise Exception(f"QUANTITY requires {quantity} more items, but only {sampler.remaining} combinations of {self.BASE_TRAITS} remain")
+
+
+    accepted = 0
+    invalid = 0
+    rng = self.get_rng(0)
+    while quantity > 0:
+      code = sampler.draw(rng)
+      if code is None:
+        logging.warning(f"Remaining {quantity}")
+        raise Exception(f"Only {accepted} new valid items exist, {invalid} combinations are invalid")
+
+      item = sampler.decode(code)
+      self.process_links(item, rng)
+      if not self.is_item_valid(item):
+        invalid += 1
+        continue
+
+      if item in self.continue_items or not new_items.add(item):
+        continue
+
+      accepted += 1
+      quantity -= 1
+
+    logging.info(f"UNIQUE: {accepted} accepted, {invalid} invalid, {sampler.remaining} combinations remain")
+
+
+  def stream_item(self, item):
+    if item['index'] < self.START_IDX:
+      return
+
+    try:
+      self.recipe_csv.writerow(item)
+    except ValueError as vErr:
+      logging.error(item)
+      raise vErr
+
+    if self.CREATE_METADATA:
+      self.generate_json(item)
+
+
+  def validate_rule(self, rule):
+    #logging.info(rule)
+
+    #check the match
+    feature = rule['match']['feature']
+    if rule['match']['is_any']:
+      self.traits[feature]
+
+    else:
+      for expression in rule['match']['expressions']:
+        self.get_trait(feature, expression)
+
+
+    for allowed in rule['allowed']:
+      feature = allowed['feature']
+      if allowed['is_any']:
+        self.traits[feature]
 
       else:
         for expression in allowed['expressions']:
@@ -836,6 +1622,30 @@ class TraitManager(object):
           else:
             self.validate_rule(rule)
 
+    if self.rule_set is None:
+      self.rule_set = RuleSet(self.rules)
+
+
+  def write_stats(self, base, total, features, ranks):
+    columns = ['feature', 'expression', 'count', 'share', 'mils', 'expected', 'deviation', 'rarity']
+    with open(f'{base}.stats.csv', 'w', newline='') as fd:
+      writer = csv.DictWriter(fd, columns)
+      writer.writeheader()
+      for feature in features:
+        for trait in feature['traits']:
+          writer.writerow({ 'feature': feature['feature'], **trait })
+
+    with open(f'{base}.stats.json', 'w') as fd:
+      json.dump({ 'count': total, 'features': features }, fd, indent=2)
+
+    with open(f'{base}.rarity.csv', 'w', newline='') as fd:
+      writer = csv.writer(fd)
+      writer.writerow(['index', 'score', 'rank'])
+      for rank, index, score in ranks:
+        writer.writerow([index, round(score, 6), rank])
+
+    logging.info(f"STATS: {total} items, wrote {base}.stats.csv, {base}.stats.json and {base}.rarity.csv")
+
 
 
 class Interruptible(object):
@@ -888,96 +1698,228 @@ class ImageMaker(Interruptible, TraitManager):
     Interruptible.__init__(self)
     TraitManager.__init__(self)    
     
+    self.compositor = COMPOSITORS['pillow']()
     self.current_trait = None
+    self.encoder = ImageEncoder()
+    self.fingerprints = {}
+    self.manifest_lock = threading.Lock()
+    self.manifest_path = None
+    self.layer_atlas = None
+    self.layer_cache = LayerCache()
+    self.layer_store = None
+    self.prefix_cache = LayerCache(0)
     self.queue = Queue()
+    self.stream_error = None
+    self.stream_queue = None
+    self.stream_thread = None
     self.threads = []
     
     self.layers_path = os.path.join(__dir__, '1-layers')
     self.images_path = os.path.join(__dir__, '2-images')
 
 
+  def benchmark_encoders(self, items):
+    images = [self.render_image(item) for item in items]
+    encoders = [
+      ImageEncoder('png'),
+      ImageEncoder('png', { 'compress_level': 1 }),
+      ImageEncoder('png', { 'compress_level': 1, 'quantize': True }),
+      ImageEncoder('png', { 'optimize': True }),
+      ImageEncoder('webp', { 'lossless': True, 'method': 0 }),
+      ImageEncoder('webp', { 'lossless': True })
+    ]
+
+    if str(self.encoder) not in [str(encoder) for encoder in encoders]:
+      encoders.append(self.encoder)
+
+    return benchmark_encoders(images, encoders)
+
+
+  def check_compositor(self, items):
+    # compare the selected compositor with the reference Pillow output
+    reference = COMPOSITORS['pillow']()
+    selected = self.compositor
+    prefix_cache = self.prefix_cache
+    worst = 0
+    for item in items:
+      try:
+        self.prefix_cache = LayerCache(0)
+        self.compositor = reference
+        expected = self.generate_layer(item)
+        self.compositor = selected
+        actual = self.generate_layer(item)
+      finally:
+        self.compositor = selected
+        self.prefix_cache = prefix_cache
+
+      # colors are meaningless where both images are fully transparent
+      alpha = ImageChops.lighter(expected.getchannel('A'), actual.getchannel('A'))
+      visible = alpha.point(lambda a: 255 if a else 0)
+      delta = 0
+      for band in 'RGBA':
+        diff = ImageChops.difference(expected.getchannel(band), actual.getchannel(band))
+        if band != 'A':
+          diff = ImageChops.multiply(diff, visible)
+
+        delta = max(delta, diff.getextrema()[1])
+
+      worst = max(worst, delta)
+      if delta > 1:
+        logging.warning(f"COMPOSITOR: Image {item['index']} differs by up to {delta}")
+
+
+    logging.info(f"COMPOSITOR: '{selected.name}' differs from 'pillow' by up to {worst} over {len(items)} items")
+    return worst
+
+
+  def close_stream(self):
+    super().close_stream()
+    if self.stream_thread:
+      self.stream_queue.put(None)
+      self.stream_thread.join()
+      self.stream_queue = None
+      self.stream_thread = None
+
+
+  def create_atlas(self, gen_items):
+    # decode every layer used by these items once, for all processes
+    layers = {}
+    for item in gen_items:
+      for trait in self.get_stack(item):
+        if trait['path'] not in layers:
+          layers[trait['path']] = self.load_layer(trait)
+
+    atlas = LayerAtlas.create(layers)
+    for layer in layers.values():
+      layer.close()
+
+    return atlas
+
+
+  def encode_image(self, composite):
+    return self.encoder.encode(composite)
+
+
+  def filter_completed(self, gen_items):
+    completed = self.load_manifest()
+    remaining = [item for item in gen_items if not self.is_completed(item, completed)]
+
+    logging.info(f"RESUME: Skipping {len(gen_items) - len(remaining)} completed images, {len(remaining)} remaining")
+    return remaining
+
+
   def generate_image(self, item):
-    self.current_item = item
+    composite = self.render_image(item)
+    data = self.encode_image(composite)
+    self.write_image(item, data)
 
-     # default - combine without shadows
-    if True:
-      # TODO: if file exists
-      # - load
-      # - dimensions
-      # - check exif :: trait hash?
-      composite = self.generate_layer(item)
 
-    # advanced - create partial layers, apply shadows, then composite
-    else:
-      '''
-      bg = {
-        'Background': item['Background'],
-        'Logo': item['Logo']
-      }
-      layer1 = self.generate_layer(bg)
+  def generate_images(self, gen_items):
+    # gen_items can be a list, or the items streamed by randomize()
+    if self.use_procs:
+      self.generate_images_procs(gen_items)
 
-      logo = {
-        'Logo': item['Logo']
-      }
-      layer3 = self.generate_layer(logo)
-      layer2 = self.generate_shadow(layer3, (-10, 2))
+    elif self.PIPELINE:
+      self.generate_images_pipeline(gen_items)
 
-      body = item.copy()
-      body.pop('Background')
-      body.pop('Logo')
+    elif self.use_threads:
+      self.generate_images_threads(gen_items)
 
-      layer5 = self.generate_layer(body)
-      layer4 = self.generate_shadow(layer5, (-50, 10))
+    else:
+      for item in gen_items:
+        if self.is_running:
+          self.generate_image(item)
+        else:
+          break
 
+    if not self.use_procs:
+      logging.info(f"LAYER CACHE: {self.layer_cache}")
+      if self.prefix_cache.max_bytes:
+        logging.info(f"PREFIX CACHE: {self.prefix_cache}")
 
-      composite = layer1.copy()
-      #composite = Image.alpha_composite(composite, layer2)
-      #composite = Image.alpha_composite(composite, layer3)
-      composite = Image.alpha_composite(composite, layer4)
-      composite = Image.alpha_composite(composite, layer5)
-      '''
 
-    save_as = os.path.join(self.images_path, '{0}.png'.format(item['index']))
-    composite.save(save_as)
-    logging.info("CREATED: Image {0}".format(item['index']))
+  def generate_images_pipeline(self, gen_items):
+    # compose, encode and write overlap; bounded queues keep memory in check
+    depth = max(1, int(self.PIPELINE_DEPTH))
+    pipeline = Pipeline()
+    pipeline.add('compose', lambda item: (item, self.render_image(item)), self.use_threads or 1, depth)
+    pipeline.add('encode', lambda job: (job[0], self.encode_image(job[1])), self.ENCODE_THREADS, depth)
+    pipeline.add('write', lambda job: self.write_image(*job), 1, depth)
+    pipeline.start()
+
+    try:
+      for item in gen_items:
+        if self.is_running:
+          pipeline.put(item)
+        else:
+          break
+
+    finally:
+      pipeline.join()
+      pipeline.report()
 
 
   def generate_images_procs(self, gen_items):
-    # raise NotImplementedError()
-    recipe0 = {
-      "index":   0,
-      "Background": "Red aqua",
-      "Body":    "4 Gold fish",
-      "Clothes": "Flannel 2",
-      "Eyes":    "Suprised",
-      "Hat":     "bone through skull",
-      "Mouth":   "Buck teeth",
-      "Neck":    "Chain on neck shirtless"
-    }
+    atlas = None
+    if self.SHARED_ATLAS:
+      if isinstance(gen_items, list):
+        atlas = self.create_atlas(gen_items)
+      else:
+        logging.warning('SHARED_ATLAS needs every item up front, and is ignored with STREAM_ITEMS')
+
+    chunk = max(1, int(self.PROCS_CHUNK))
+    gen_items = iter(gen_items)
+    created = 0
+    failed = []
+    caches = {}
+    initargs = (type(self), self.get_config(), self.traits, atlas.handle if atlas else None)
+    try:
+      with mp.Pool(self.use_procs, _init_worker, initargs) as pool:
+        # at most 2 chunks per process in flight, so a stream of items stays bounded
+        pending = deque()
+        while True:
+          while len(pending) < 2 * self.use_procs:
+            items = list(itertools.islice(gen_items, chunk))
+            if not items:
+              break
+
+            pending.append(pool.apply_async(_process_chunk, (items,)))
+
+          if not pending:
+            break
+
+          pid, results, cache = pending.popleft().get()
+          caches[pid] = cache
+          for index, error in results:
+            if error:
+              failed.append(index)
+              logging.error("FAILED: Image {0}: {1}".format(index, error))
+            else:
+              created += 1
+
+          if not self.is_running:
+            logging.warning('Terminating image processes...')
+            pool.terminate()
+            break
 
-    test0 = json.dumps(recipe0)
+    finally:
+      if atlas:
+        atlas.close()
 
-    #mp.set_start_method('spawn')
-    queue = mp.JoinableQueue()
-    
-    
-    proc = ImageProcessor(queue)
-    proc.start()
-    logging.info('... started')
 
-    queue.put(Task(test0))
-    queue.join()
+    for pid, cache in caches.items():
+      logging.info(f"LAYER CACHE ({pid}): {cache}")
+
+    logging.info(f"PROCS: {created} images created, {len(failed)} failed")
+    if failed:
+      logging.warning(f"PROCS: failed {sorted(failed)}")
+
+    return failed
 
 
-    # poison pill
-    queue.put(Task.Empty)
-    proc.join()
-    logging.info('proc joined')
-    exit()  
-  
-  
   def generate_images_threads(self, gen_items):
-    # start the background threads
+    # start the background threads; a bounded queue keeps a stream of items from piling up
+    self.queue = Queue(2 * self.use_threads)
     self.threads = []
     for i in range(self.use_threads):
       t = threading.Thread(target=self.process_image, daemon=False)
@@ -986,7 +1928,10 @@ class ImageMaker(Interruptible, TraitManager):
 
     # enqueue images to generate
     for item in gen_items:
-      self.queue.put(item)
+      if self.is_running:
+        self.queue.put(item)
+      else:
+        break
 
     # stop the background threads
     for t in self.threads:
@@ -1000,67 +1945,70 @@ class ImageMaker(Interruptible, TraitManager):
     super().generate_items()
 
     if self.CREATE_IMAGES:
-      gen_items = []
-      all_items = [*self.continue_items, *self.new_items]
-      for idx in range(self.START_IDX, len(all_items)):
-        gen_items.append(all_items[idx])
-
-    
-      if self.use_procs:
-        self.generate_images_procs(gen_items)
+      gen_items = list(self.get_items(self.START_IDX))
 
-      elif self.use_threads:
-        self.generate_images_threads(gen_items)
+      if self.CHECK_COMPOSITOR:
+        self.check_compositor(gen_items[:self.CHECK_COMPOSITOR])
 
-      else:
-        for item in gen_items:
-          if self.is_running:
-            self.generate_image(item)
-          else:
-            break
+      if self.BENCHMARK_ENCODERS:
+        self.benchmark_encoders(gen_items[:self.BENCHMARK_ENCODERS])
+        logging.warning('Skipping image generation after the encoder benchmark')
+        return
 
+      if self.RESUME:
+        gen_items = self.filter_completed(gen_items)
 
-  def generate_layer(self, item):
-    layers = {}
-    for feature, expression in item.items():
-      self.current_trait = None
-      if feature != 'index':
-        self.current_trait = current_trait = self.get_trait(feature, expression)
+      # neighbors share the longest prefixes
+      if self.prefix_cache.max_bytes:
+        gen_items.sort(key=self.get_stack_key)
 
-        if current_trait['path']:
-          layers[current_trait['z']] = self.get_image(current_trait)
-        elif expression and current_trait['z'] > 0:
-          logging.warning(f"{feature}: {expression} does not have a path"  )
+      self.generate_images(gen_items)
 
-    self.current_trait = None
 
+  def generate_layer(self, item):
+    stack = self.get_stack(item)
+    keys = tuple((trait['z'], trait['feature'], trait['expression']) for trait in stack)
 
+    # resume from the deepest cached prefix of this stack
     composite = None
-    indices = sorted(layers.keys())
-    for i in indices:
-      if i in layers:
-        if composite:
-          try:
-            #logging.debug("Appending layer {0} - {1}: {2}".format(i, layers[i]['feature'], layers[i]['expression']) )
-            composite = Image.alpha_composite(composite, layers[i]['image'])
-
-          except Exception as ex:
-            logging.error("Composite failed with layer '{0}:{1}'".format(layers[i]['feature'], layers[i]['expression']) )
-            raise ex
-
-        else:
-          #logging.debug("Base layer {0} - {1}: {2}".format(i, layers[i]['feature'], layers[i]['expression']) )
-          composite = layers[i]['image'].copy()
+    start = 0
+    if self.prefix_cache.max_bytes != 0 and len(stack) > 1:
+      prefixes = [keys[:depth] for depth in range(len(stack) - 1, 0, -1)]
+      prefix, cached = self.prefix_cache.get_first(prefixes)
+      if prefix:
+        composite = self.compositor.copy(cached)
+        start = len(prefix)
+
+
+    for depth in range(start, len(stack)):
+      trait = stack[depth]
+      layer = self.get_image(trait)
+      if composite is not None:
+        try:
+          #logging.debug("Appending layer {0} - {1}: {2}".format(trait['z'], trait['feature'], trait['expression']) )
+          self.compositor.blend(composite, layer)
 
-        if self.LOW_MEM:
-          layers[i]['image'].close()
+        except Exception as ex:
+          logging.error("Composite failed with layer '{0}:{1}'".format(trait['feature'], trait['expression']) )
+          raise ex
 
       else:
-        #logging.debug("Omit layer {0}".format(i))
-        pass
+        #logging.debug("Base layer {0} - {1}: {2}".format(trait['z'], trait['feature'], trait['expression']) )
+        composite = self.compositor.new_canvas(layer)
 
+      # the full stack is unique per item, so only partial stacks are worth keeping
+      if self.prefix_cache.max_bytes != 0 and depth + 1 < len(stack):
+        prefix = keys[:depth + 1]
+        nbytes = self.compositor.nbytes(composite)
+        # put() would drop a composite larger than the whole cache, so don't copy it
+        if (self.prefix_cache.max_bytes is None or nbytes <= self.prefix_cache.max_bytes) and prefix not in self.prefix_cache:
+          self.prefix_cache.put(prefix, self.compositor.copy(composite), nbytes)
 
-    return composite
+
+    if composite is None:
+      return None
+    else:
+      return self.compositor.to_image(composite)
 
 
   def generate_shadow(self, layer, translation):
@@ -1070,29 +2018,71 @@ class ImageMaker(Interruptible, TraitManager):
     return shadow
 
 
-  def get_image(self, trait):
-    if self.LOW_MEM:
-      trait = trait.copy()
-      logging.info("LOAD:  Image '{0}'".format(trait['path']) )
-      trait['image'] = Image.open(trait['path']).convert('RGBA')
-      if self.RESIZE:
-        trait['image'] = trait['image'].resize(self.RESIZE)
+  def get_config(self):
+    config = super().get_config()
+    config['images_path'] = self.images_path
+    config['layers_path'] = self.layers_path
+    return config
 
-      return trait
 
-    else:
+  def get_image(self, trait):
+    key = trait['path']
+    if self.layer_atlas:
+      layer = self.layer_atlas.get(key)
+      if layer is not None:
+        return layer
+
+    layer = self.layer_cache.get(key)
+    if layer is not None:
+      logging.debug("CACHE: Use image '{0}'".format(trait['path']) )
+      return layer
+
+    layer = self.load_layer(trait)
+    self.layer_cache.put(key, layer, layer.nbytes + self.compositor.prepare(layer))
+    return layer
+
+
+  def get_item_hash(self, item):
+    # anything that changes the output image changes the hash
+    recipe = sorted((key, value) for key, value in item.items() if key != 'index' and value)
+    sources = []
+    for trait in self.get_stack(item):
       try:
-        image = trait['image']
-        logging.debug("CACHE: Use image '{0}'".format(trait['path']) )
-        return trait
-
+        fingerprint = self.fingerprints[trait['path']]
       except KeyError:
-        logging.info("LOAD:  Image '{0}'".format(trait['path']) )
-        trait['image'] = Image.open(trait['path']).convert('RGBA')
-        if self.RESIZE:
-          trait['image'] = trait['image'].resize(self.RESIZE)
-        
-        return trait
+        fingerprint = self.fingerprints[trait['path']] = get_fingerprint(trait['path'])[1:]
+
+      sources.append((trait['path'], *fingerprint))
+
+    data = json.dumps([recipe, sources, self.RESIZE, self.COMPOSITOR, str(self.encoder)])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+  def get_stack(self, item):
+    layers = {}
+    for feature, expression in item.items():
+      self.current_trait = None
+      if feature != 'index':
+        self.current_trait = current_trait = self.get_trait(feature, expression)
+
+        if current_trait['path']:
+          layers[current_trait['z']] = current_trait
+        elif expression and current_trait['z'] > 0:
+          logging.warning(f"{feature}: {expression} does not have a path"  )
+
+    self.current_trait = None
+    return [layers[z] for z in sorted(layers.keys())]
+
+
+  def get_stack_key(self, item):
+    return tuple((trait['z'], trait['feature'], trait['expression']) for trait in self.get_stack(item))
+
+
+  def get_stream_items(self, items):
+    completed = self.load_manifest() if self.RESUME else {}
+    for item in items:
+      if not self.is_completed(item, completed):
+        yield item
 
 
   def init(self):
@@ -1105,6 +2095,96 @@ class ImageMaker(Interruptible, TraitManager):
       pass
 
     TraitManager.init(self)
+    self.init_caches()
+    self.init_compositor()
+    self.init_encoder()
+    self.init_manifest()
+
+
+  def init_caches(self):
+    if self.LOW_MEM:
+      max_bytes = 0
+    elif self.LAYER_CACHE_MB is None:
+      max_bytes = None
+    else:
+      max_bytes = int(float(self.LAYER_CACHE_MB) * 1048576)
+
+    self.layer_cache = LayerCache(max_bytes)
+    self.prefix_cache = LayerCache(int(float(self.PREFIX_CACHE_MB) * 1048576))
+
+    if self.LAYER_CACHE_PATH:
+      if os.path.isabs(self.LAYER_CACHE_PATH):
+        store_path = self.LAYER_CACHE_PATH
+      else:
+        store_path = os.path.join(self.base_path, self.LAYER_CACHE_PATH)
+
+      self.layer_store = LayerStore(store_path, self.RESIZE)
+
+
+  def init_compositor(self):
+    try:
+      self.compositor = COMPOSITORS[self.COMPOSITOR]()
+    except KeyError:
+      raise NotImplementedError(f"Unsupported compositor: '{self.COMPOSITOR}'")
+
+
+  def init_encoder(self):
+    self.encoder = ImageEncoder(self.OUTPUT_FORMAT, self.OUTPUT_OPTIONS)
+    logging.info(f"ENCODER: {self.encoder}")
+
+
+  def init_manifest(self):
+    self.manifest_path = os.path.join(self.images_path, 'manifest.csv')
+
+
+  def is_completed(self, item, completed):
+    index = str(item['index'])
+    save_as = os.path.join(self.images_path, '{0}{1}'.format(index, self.encoder.extension))
+    return completed.get(index) == self.get_item_hash(item) and os.path.isfile(save_as)
+
+
+  def load_layer(self, trait):
+    if self.layer_store:
+      layer = self.layer_store.load(trait['path'])
+      if layer is not None:
+        logging.debug("STORE: Use image '{0}'".format(trait['path']) )
+        return layer
+
+    logging.info("LOAD:  Image '{0}'".format(trait['path']) )
+    layer = Layer.open(trait['path'], self.RESIZE)
+    if self.layer_store:
+      self.layer_store.save(trait['path'], layer)
+
+    return layer
+
+
+  def load_manifest(self):
+    completed = {}
+    try:
+      with open(self.manifest_path, newline='') as fd:
+        for row in csv.reader(fd):
+          # later rows replace earlier ones; incomplete rows are ignored
+          if len(row) == 2 and len(row[1]) == 40:
+            completed[row[0]] = row[1]
+
+    except FileNotFoundError:
+      pass
+
+    return completed
+
+
+  def open_stream(self):
+    # images are generated in the background while randomize() is still drawing
+    self.stream_error = None
+    if self.CREATE_IMAGES:
+      if self.CHECK_COMPOSITOR or self.BENCHMARK_ENCODERS:
+        logging.warning('CHECK_COMPOSITOR and BENCHMARK_ENCODERS are ignored with STREAM_ITEMS')
+
+      self.stream_queue = Queue(max(1, int(self.PIPELINE_DEPTH)))
+      self.stream_thread = threading.Thread(target=self.process_stream, daemon=True)
+      self.stream_thread.start()
+
+    super().open_stream()
 
 
   def process_image(self):
@@ -1122,3 +2202,161 @@ class ImageMaker(Interruptible, TraitManager):
       except Exception as ex:
         logging.exception(ex)
         self.queue.task_done()
+
+
+  def process_stream(self):
+    items = iter(self.stream_queue.get, None)
+    try:
+      self.generate_images(self.get_stream_items(items))
+    except Exception as ex:
+      logging.exception(ex)
+      self.stream_error = ex
+    finally:
+      # after an error or an interrupt, keep stream_item() from blocking on a full queue
+      for _ in items:
+        pass
+
+
+  def render_image(self, item):
+    self.current_item = item
+
+     # default - combine without shadows
+    if True:
+      composite = self.generate_layer(item)
+
+    # advanced - create partial layers, apply shadows, then composite
+    else:
+      '''
+      bg = {
+        'Background': item['Background'],
+        'Logo': item['Logo']
+      }
+      layer1 = self.generate_layer(bg)
+
+      logo = {
+        'Logo': item['Logo']
+      }
+      layer3 = self.generate_layer(logo)
+      layer2 = self.generate_shadow(layer3, (-10, 2))
+
+      body = item.copy()
+      body.pop('Background')
+      body.pop('Logo')
+
+      layer5 = self.generate_layer(body)
+      layer4 = self.generate_shadow(layer5, (-50, 10))
+
+
+      composite = layer1.copy()
+      #composite = Image.alpha_composite(composite, layer2)
+      #composite = Image.alpha_composite(composite, layer3)
+      composite = Image.alpha_composite(composite, layer4)
+      composite = Image.alpha_composite(composite, layer5)
+      '''
+
+    return composite
+
+
+  def stream_item(self, item):
+    super().stream_item(item)
+    if self.stream_error:
+      raise Exception(f"Image generation failed: {self.stream_error}")
+
+    if not self.is_running:
+      raise Exception("Interrupted")
+
+    if self.stream_queue and item['index'] >= self.START_IDX:
+      self.stream_queue.put(item)
+
+
+  def write_image(self, item, data):
+    save_as = os.path.join(self.images_path, '{0}{1}'.format(item['index'], self.encoder.extension))
+    temp_path = '{0}.{1}-{2}.tmp'.format(save_as, os.getpid(), threading.get_ident())
+    with open(temp_path, 'wb') as fd:
+      fd.write(data)
+
+    os.replace(temp_path, save_as)
+    self.write_manifest(item)
+    logging.info("CREATED: Image {0}".format(item['index']))
+
+
+  def write_manifest(self, item):
+    line = '{0},{1}\n'.format(item['index'], self.get_item_hash(item))
+    with self.manifest_lock:
+      with open(self.manifest_path, 'a', newline='') as fd:
+        fd.write(line)
+
+
+
+# worker state for ImageMaker.generate_images_procs
+_worker = None
+
+def _init_worker(cls, config, traits, atlas=None):
+  global _worker
+
+  # the parent process handles interrupts
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  if not logging.getLogger().handlers:
+    cls.default_logging()
+
+  _worker = cls()
+  for key, value in config.items():
+    setattr(_worker, key, value)
+
+  _worker.traits = traits
+  _worker.init_caches()
+  _worker.init_compositor()
+  _worker.init_encoder()
+  _worker.init_manifest()
+  if atlas:
+    _worker.layer_atlas = LayerAtlas.attach(atlas)
+
+
+def _process_chunk(items):
+  results = []
+  for item in items:
+    try:
+      _worker.generate_image(item)
+      results.append((item['index'], None))
+
+    except Exception as ex:
+      logging.exception(ex)
+      results.append((item['index'], str(ex)))
+
+  return (os.getpid(), results, str(_worker.layer_cache))
+
+
+# worker state for TraitManager.randomize_items_procs
+_randomizer = None
+
+def _init_randomizer(cls, config, traits, weights, populations):
+  global _randomizer
+
+  # the parent process handles interrupts
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  if not logging.getLogger().handlers:
+    cls.default_logging()
+
+  _randomizer = cls()
+  for key, value in config.items():
+    setattr(_randomizer, key, value)
+
+  _randomizer.traits = traits
+  _randomizer.compile_trait_samplers()
+  _randomizer.compile_links()
+  _randomizer.codec = TraitCodec(traits)
+  _randomizer.samplers = [(feature, TraitSampler(populations[feature], weights[feature] or ())) for feature in weights]
+
+
+def _randomize_shard(shard, i):
+  # candidates travel back as one array of trait codes
+  codec = _randomizer.codec
+  rows = array(codec.typecode)
+  for item in _randomizer.randomize_candidates(_randomizer.samplers, shard, i):
+    row = codec.encode(item)
+    if row is None:
+      raise Exception(f"Item has traits that aren't in traits.csv: {item}")
+
+    rows.extend(row)
+
+  return rows
@@ -0,0 +1,234 @@
+
+from array import array
+
+
+class TraitCodec(object):
+  # interns each feature's expressions to small integers; code 0 is "no trait"
+  def __init__(self, traits):
+    self.features = list(traits.keys())
+    self.expressions = [('', *traits[feature].keys()) for feature in self.features]
+    self.codes = [{ expression: code for code, expression in enumerate(expressions) } for expressions in self.expressions]
+    self.columns = { feature: column for column, feature in enumerate(self.features) }
+
+    # a row is packed into one integer, mixed-radix over the features
+    self.strides = []
+    self.space = 1
+    for expressions in self.expressions:
+      self.strides.append(self.space)
+      self.space *= len(expressions)
+
+    self.typecode = 'B' if max(map(len, self.expressions), default=0) <= 256 else 'I'
+    self.width = len(self.features)
+
+
+  def decode(self, row):
+    item = {}
+    for feature, expressions, code in zip(self.features, self.expressions, row):
+      if code:
+        item[feature] = expressions[code]
+
+    return item
+
+
+  def encode(self, item):
+    # None if the item has a trait that isn't in traits.csv
+    row = [0] * self.width
+    for feature, expression in item.items():
+      if feature == 'index' or not expression:
+        continue
+
+      try:
+        column = self.columns[feature]
+        row[column] = self.codes[column][expression]
+      except KeyError:
+        return None
+
+    return row
+
+
+  def pack(self, row):
+    key = 0
+    for code, stride in zip(row, self.strides):
+      key += code * stride
+
+    return key
+
+
+  def unpack(self, key):
+    row = []
+    for expressions in self.expressions:
+      key, code = divmod(key, len(expressions))
+      row.append(code)
+
+    return row
+
+
+
+class ItemList(object):
+  # items as dicts, deduplicated by their sorted (feature, expression) pairs
+  def __init__(self, items=()):
+    self.items = {}
+    self.extend(items)
+
+
+  def __contains__(self, item):
+    return self.get_key(item) in self.items
+
+
+  def __iter__(self):
+    return iter(self.items.values())
+
+
+  def __len__(self):
+    return len(self.items)
+
+
+  def add(self, item):
+    # False if the item is a duplicate
+    key = self.get_key(item)
+    if key in self.items:
+      return False
+
+    self.items[key] = item
+    return True
+
+
+  def extend(self, items):
+    for item in items:
+      self.add(item)
+
+
+  @staticmethod
+  def get_key(item):
+    return tuple(sorted((key, value) for key, value in item.items() if key != 'index' and value))
+
+
+  def set_indexes(self, start):
+    for index, item in enumerate(self.items.values(), start):
+      item['index'] = index
+
+
+
+class ItemStream(object):
+  # accepted items are numbered and handed to emit(item) instead of being kept; only their packed keys stay in memory
+  def __init__(self, codec, emit, start=0):
+    self.codec = codec
+    self.emit = emit
+    self.keys = set()
+    self.start = start
+
+
+  def __contains__(self, item):
+    row = self.codec.encode(item)
+    return row is not None and self.codec.pack(row) in self.keys
+
+
+  def __iter__(self):
+    # the emitted items, rebuilt from their keys (in no particular order, without 'index')
+    for key in self.keys:
+      yield self.codec.decode(self.codec.unpack(key))
+
+
+  def __len__(self):
+    return len(self.keys)
+
+
+  def add(self, item):
+    # False if the item is a duplicate
+    row = self.codec.encode(item)
+    if row is None:
+      raise Exception(f"Item has traits that aren't in traits.csv: {item}")
+
+    key = self.codec.pack(row)
+    if key in self.keys:
+      return False
+
+    item['index'] = self.start + len(self.keys)
+    self.keys.add(key)
+    self.emit(item)
+    return True
+
+
+  def extend(self, items):
+    for item in items:
+      self.add(item)
+
+
+  def set_indexes(self, start):
+    # items are numbered as they are emitted
+    if start != self.start:
+      raise Exception(f"Streamed items are already numbered from {self.start}")
+
+
+
+class ItemTable(object):
+  # items as fixed-width rows of trait codes, deduplicated by their packed keys
+  def __init__(self, codec, items=()):
+    self.codec = codec
+    self.keys = set()
+    self.rows = array(codec.typecode)
+    self.start = None
+    self.extend(items)
+
+
+  def __contains__(self, item):
+    row = self.codec.encode(item)
+    return row is not None and self.codec.pack(row) in self.keys
+
+
+  def __getitem__(self, index):
+    return self.get(index)
+
+
+  def __iter__(self):
+    for index in range(len(self)):
+      yield self.get(index)
+
+
+  def __len__(self):
+    return len(self.rows) // max(1, self.codec.width)
+
+
+  def add(self, item):
+    # False if the item is a duplicate
+    row = self.codec.encode(item)
+    if row is None:
+      raise Exception(f"Item has traits that aren't in traits.csv: {item}")
+
+    return self.add_row(row)
+
+
+  def add_row(self, row):
+    key = self.codec.pack(row)
+    if key in self.keys:
+      return False
+
+    self.keys.add(key)
+    self.rows.extend(row)
+    return True
+
+
+  def extend(self, items):
+    for item in items:
+      self.add(item)
+
+
+  def get(self, index):
+    # strings are only materialized here
+    if index < 0:
+      index += len(self)
+
+    item = self.codec.decode(self.get_row(index))
+    if self.start is not None:
+      item['index'] = self.start + index
+
+    return item
+
+
+  def get_row(self, index):
+    width = self.codec.width
+    return self.rows[index * width:(index + 1) * width]
+
+
+  def set_indexes(self, start):
+    self.start = start
@@ -0,0 +1,361 @@
+
+import hashlib, json, logging, mmap, os, threading
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from PIL import Image
+
+
+class Layer(object):
+  __slots__ = ('image', 'offset', 'pixels', 'size')
+
+  def __init__(self, image, offset=(0, 0), size=None):
+    # image:  the cropped RGBA pixels, or None if the layer is fully transparent
+    # offset: top-left corner of the crop within the full canvas
+    # pixels: optional compositor-specific copy of the image
+    # size:   dimensions of the full canvas
+    self.image = image
+    self.offset = tuple(offset)
+    self.pixels = None
+    self.size = tuple(size or image.size)
+
+
+  def close(self):
+    self.pixels = None
+    if self.image:
+      self.image.close()
+      self.image = None
+
+
+  def composite(self, canvas):
+    # blend only the cropped region into the canvas (in place)
+    if self.image:
+      canvas.alpha_composite(self.image, self.offset)
+
+    return canvas
+
+
+  @classmethod
+  def crop(cls, image):
+    size = image.size
+    bbox = image.getchannel('A').getbbox()
+    if bbox is None:
+      logging.debug('CROP:  Layer is empty')
+      image.close()
+      return cls(None, (0, 0), size)
+
+    if bbox == (0, 0, *size):
+      return cls(image, (0, 0), size)
+
+    cropped = image.crop(bbox)
+    image.close()
+    return cls(cropped, bbox[:2], size)
+
+
+  def is_full(self):
+    return bool(self.image) and self.offset == (0, 0) and self.image.size == self.size
+
+
+  @property
+  def nbytes(self):
+    if self.image:
+      width, height = self.image.size
+      return width * height * len(self.image.getbands())
+    else:
+      return 0
+
+
+  @classmethod
+  def open(cls, path, resize=None):
+    image = Image.open(path).convert('RGBA')
+    if resize:
+      image = image.resize(resize)
+
+    return cls.crop(image)
+
+
+  def to_canvas(self):
+    if self.is_full():
+      return self.image.copy()
+
+    canvas = Image.new('RGBA', self.size)
+    if self.image:
+      canvas.paste(self.image, self.offset)
+
+    return canvas
+
+
+
+def get_fingerprint(path):
+  stat = os.stat(path)
+  return (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+
+
+
+class LayerAtlas(object):
+  def __init__(self, shm, index, owner=False):
+    # index: key => (offset, nbytes, crop size, crop offset, canvas size)
+    self.index = index
+    self.layers = {}
+    self.lock = threading.Lock()
+    self.owner = owner
+    self.shm = shm
+
+
+  def __contains__(self, key):
+    return key in self.index
+
+
+  def __len__(self):
+    return len(self.index)
+
+
+  @classmethod
+  def attach(cls, handle):
+    name, index = handle
+    return cls(shared_memory.SharedMemory(name=name), index)
+
+
+  def close(self):
+    self.layers = {}
+    if self.shm:
+      self.shm.close()
+      if self.owner:
+        self.shm.unlink()
+
+      self.shm = None
+
+
+  @classmethod
+  def create(cls, layers):
+    # layers: key => Layer
+    index = {}
+    nbytes = 0
+    for key, layer in layers.items():
+      crop = layer.image.size if layer.image else None
+      index[key] = (nbytes, layer.nbytes, crop, layer.offset, layer.size)
+      nbytes += layer.nbytes
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+    for key, layer in layers.items():
+      start, length, _, _, _ = index[key]
+      if length:
+        shm.buf[start:start + length] = layer.image.tobytes()
+
+    logging.info('ATLAS: {0} layers, {1:.1f} MB'.format(len(index), nbytes / 1048576))
+    return cls(shm, index, True)
+
+
+  def get(self, key):
+    try:
+      return self.layers[key]
+    except KeyError:
+      pass
+
+    try:
+      start, length, crop, offset, size = self.index[key]
+    except KeyError:
+      return None
+
+    # wrap the shared buffer without copying it
+    image = None
+    if crop:
+      image = Image.frombuffer('RGBA', crop, self.shm.buf[start:start + length], 'raw', 'RGBA', 0, 1)
+
+    with self.lock:
+      return self.layers.setdefault(key, Layer(image, offset, size))
+
+
+  @property
+  def handle(self):
+    return (self.shm.name, self.index)
+
+
+
+class LayerStore(object):
+  VERSION = 1
+
+  def __init__(self, path, resize=None):
+    self.path = path
+    self.resize = tuple(resize) if resize else None
+    os.makedirs(self.path, exist_ok=True)
+
+
+  def get_key(self, path):
+    # invalidated by any change to the source file or the resize target
+    data = json.dumps([self.VERSION, *get_fingerprint(path), self.resize])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+  def load(self, path):
+    key = self.get_key(path)
+    meta_path = os.path.join(self.path, f'{key}.json')
+    try:
+      with open(meta_path) as fd:
+        meta = json.load(fd)
+    except (FileNotFoundError, ValueError):
+      return None
+
+    image = None
+    if meta['crop']:
+      try:
+        with open(os.path.join(self.path, f'{key}.rgba'), 'rb') as fd:
+          buffer = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        image = Image.frombuffer('RGBA', tuple(meta['crop']), buffer, 'raw', 'RGBA', 0, 1)
+
+      except (FileNotFoundError, ValueError):
+        logging.warning(f"STORE: Ignoring incomplete entry for '{path}'")
+        return None
+
+    return Layer(image, meta['offset'], meta['size'])
+
+
+  def save(self, path, layer):
+    # other threads and processes may be saving the same layer
+    key = self.get_key(path)
+    suffix = f'{os.getpid()}-{threading.get_ident()}.tmp'
+    if layer.image:
+      blob_path = os.path.join(self.path, f'{key}.rgba')
+      with open(f'{blob_path}.{suffix}', 'wb') as fd:
+        fd.write(layer.image.tobytes())
+
+      os.replace(f'{blob_path}.{suffix}', blob_path)
+
+
+    # the metadata is written last and marks the entry as complete
+    meta_path = os.path.join(self.path, f'{key}.json')
+    with open(f'{meta_path}.{suffix}', 'w') as fd:
+      json.dump({
+        'crop':   layer.image.size if layer.image else None,
+        'offset': layer.offset,
+        'path':   path,
+        'size':   layer.size
+      }, fd)
+
+    os.replace(f'{meta_path}.{suffix}', meta_path)
+
+
+
+class LayerCache(object):
+  # share of the budget reserved for entries that have been hit at least once
+  PROTECTED = 0.8
+
+  def __init__(self, max_bytes=None):
+    # max_bytes: None = unbounded, 0 = disabled
+    self.lock = threading.Lock()
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+
+    # segmented LRU: new entries wait in probation, hits promote them to protected
+    self.probation = OrderedDict()
+    self.protected = OrderedDict()
+    self.protected_bytes = 0
+
+    self.evictions = 0
+    self.hits = 0
+    self.misses = 0
+
+
+  def __contains__(self, key):
+    with self.lock:
+      return key in self.probation or key in self.protected
+
+
+  def __len__(self):
+    return len(self.probation) + len(self.protected)
+
+
+  def __str__(self):
+    total = self.hits + self.misses
+    ratio = self.hits / total if total else 0.0
+    return '{0} entries, {1:.1f} MB, {2} hits, {3} misses, {4} evictions ({5:.1%} hit rate)'.format(
+      len(self), self.nbytes / 1048576, self.hits, self.misses, self.evictions, ratio)
+
+
+  def clear(self):
+    with self.lock:
+      self.probation.clear()
+      self.protected.clear()
+      self.nbytes = 0
+      self.protected_bytes = 0
+
+
+  def get(self, key):
+    with self.lock:
+      entry = self._touch(key)
+      if entry:
+        self.hits += 1
+        return entry[0]
+
+      self.misses += 1
+      return None
+
+
+  def get_first(self, keys):
+    # look up candidate keys in order, counting a single hit or miss
+    with self.lock:
+      for key in keys:
+        entry = self._touch(key)
+        if entry:
+          self.hits += 1
+          return (key, entry[0])
+
+      self.misses += 1
+      return (None, None)
+
+
+  def put(self, key, value, nbytes):
+    if self.max_bytes is not None and nbytes > self.max_bytes:
+      return False
+
+    with self.lock:
+      if key in self.probation or key in self.protected:
+        return True
+
+      self.probation[key] = (value, nbytes)
+      self.nbytes += nbytes
+      self._evict()
+      return True
+
+
+  def _touch(self, key):
+    if key in self.protected:
+      self.protected.move_to_end(key)
+      return self.protected[key]
+
+    if key in self.probation:
+      entry = self.probation.pop(key)
+      self.protected[key] = entry
+      self.protected_bytes += entry[1]
+      self._demote()
+      return entry
+
+    return None
+
+
+  def _demote(self):
+    if self.max_bytes is None:
+      return
+
+    limit = self.max_bytes * self.PROTECTED
+    while self.protected_bytes > limit and len(self.protected) > 1:
+      key, entry = self.protected.popitem(last=False)
+      self.protected_bytes -= entry[1]
+      self.probation[key] = entry
+
+
+  def _evict(self):
+    if self.max_bytes is None:
+      return
+
+    while self.nbytes > self.max_bytes:
+      if self.probation:
+        _, (_, nbytes) = self.probation.popitem(last=False)
+      elif self.protected:
+        _, (_, nbytes) = self.protected.popitem(last=False)
+        self.protected_bytes -= nbytes
+      else:
+        break
+
+      self.nbytes -= nbytes
+      self.evictions += 1
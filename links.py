@@ -0,0 +1,118 @@
+
+import logging, random
+
+
+class LinkGraph(object):
+  # link:feature / link:expression compiled into chains of assignments
+  def __init__(self, traits, get_sampler):
+    # (feature, expression) => (feature, expression, sampler) or None; '*' links keep a sampler instead of an expression
+    self.edges = {}
+    for feature, expressions in traits.items():
+      for expression, trait in expressions.items():
+        linked = trait['link:feature']
+        if not linked:
+          self.edges[(feature, expression)] = None
+        elif trait['link:expression'] == '*':
+          self.edges[(feature, expression)] = (linked, None, get_sampler(linked))
+        else:
+          self.edges[(feature, expression)] = (linked, trait['link:expression'], None)
+
+    for node, edge in self.edges.items():
+      if edge and edge[2] is None and edge[:2] not in self.edges:
+        logging.warning("Link target not found: {0}:{1} -> {2}:{3}".format(*node, *edge[:2]))
+
+    self.check_cycles()
+
+    # (feature, expression) => the assignments up to, and including, the first '*' link
+    self.chains = {}
+    for node in self.edges:
+      self.chains[node] = self.get_chain(node)
+
+    self.has_random = any(edge and edge[2] is not None for edge in self.edges.values())
+
+
+  def check_cycles(self):
+    # iterative DFS; a '*' link can lead to any expression of its feature
+    done = set()
+    for start in self.edges:
+      if start in done:
+        continue
+
+      path = [start]
+      on_path = { start }
+      pending = [iter(self.get_targets(start))]
+      while pending:
+        node = next(pending[-1], None)
+        if node is None:
+          pending.pop()
+          node = path.pop()
+          on_path.discard(node)
+          done.add(node)
+          continue
+
+        if node in on_path:
+          cycle = path[path.index(node):] + [node]
+          raise Exception("Link cycle: {0}".format(' -> '.join(f"{feature}:{expression}" for feature, expression in cycle)))
+
+        if node in done:
+          continue
+
+        path.append(node)
+        on_path.add(node)
+        pending.append(iter(self.get_targets(node)))
+
+
+  def get_chain(self, node):
+    chain = []
+    edge = self.edges.get(node)
+    while edge:
+      chain.append(edge)
+      feature, expression, sampler = edge
+      if sampler is not None:
+        break
+
+      edge = self.edges.get((feature, expression))
+
+    return tuple(chain)
+
+
+  def get_targets(self, node):
+    edge = self.edges.get(node)
+    if not edge:
+      return ()
+
+    feature, expression, sampler = edge
+    if sampler is not None:
+      return [(feature, expression) for expression in sampler.population]
+    else:
+      return [(feature, expression)]
+
+
+  def resolve(self, item, rng=random):
+    # same result as following each trait's links in item order
+    modified = False
+    for node in list(item.items()):
+      try:
+        chain = self.chains[node]
+      except KeyError:
+        logging.error('{0}:{1}'.format(*node))
+        raise
+
+      while chain:
+        modified = True
+        for feature, expression, sampler in chain:
+          if sampler is not None:
+            expression = sampler.sample(rng)
+
+          item[feature] = expression
+
+        if sampler is None:
+          break
+
+        try:
+          chain = self.chains[(feature, expression)]
+        except KeyError:
+          logging.error(f'{feature}:{expression}')
+          raise
+
+    return modified
@@ -0,0 +1,119 @@
+
+import logging, threading, time
+from queue import Queue
+
+
+class Stage(object):
+  def __init__(self, name, func, workers=1, depth=0):
+    self.func = func
+    self.name = name
+    self.queue = Queue(depth)
+    self.threads = []
+    self.workers = max(1, workers)
+
+    # stats
+    self.lock = threading.Lock()
+    self.count = 0
+    self.depth_max = 0
+    self.depth_sum = 0
+    self.errors = 0
+    self.puts = 0
+    self.seconds = 0.0
+
+
+  def __str__(self):
+    avg_ms = 1000 * self.seconds / self.count if self.count else 0.0
+    avg_depth = self.depth_sum / self.puts if self.puts else 0.0
+    busy = self.seconds / self.workers
+    return '{0:8} {1} workers, {2} items, {3} errors, {4:.1f} ms/item, {5:.1f}s busy/worker, queue avg {6:.1f} max {7}'.format(
+      self.name, self.workers, self.count, self.errors, avg_ms, busy, avg_depth, self.depth_max)
+
+
+  def put(self, payload):
+    depth = self.queue.qsize()
+    with self.lock:
+      self.puts += 1
+      self.depth_sum += depth
+      self.depth_max = max(self.depth_max, depth)
+
+    self.queue.put(payload)
+
+
+
+class Pipeline(object):
+  def __init__(self):
+    self.is_running = False
+    self.stages = []
+    self.started = None
+
+
+  def add(self, name, func, workers=1, depth=0):
+    # func(payload) returns the payload for the next stage, or None to drop it
+    self.stages.append(Stage(name, func, workers, depth))
+    return self
+
+
+  def join(self):
+    # drain each stage in order, then stop its workers
+    for stage in self.stages:
+      for _ in stage.threads:
+        stage.queue.put(None)
+
+      for thread in stage.threads:
+        thread.join()
+
+    self.is_running = False
+    return self
+
+
+  def put(self, payload):
+    self.stages[0].put(payload)
+
+
+  def report(self):
+    elapsed = time.perf_counter() - self.started
+    for stage in self.stages:
+      logging.info(f"PIPELINE: {stage}")
+
+    # the stage with the most busy time per worker limits the throughput
+    bottleneck = max(self.stages, key=lambda s: s.seconds / s.workers)
+    logging.info(f"PIPELINE: {elapsed:.1f}s elapsed, bottleneck '{bottleneck.name}'")
+
+
+  def run(self, stage, after):
+    while True:
+      payload = stage.queue.get()
+      if payload is None:
+        break
+
+      start = time.perf_counter()
+      try:
+        result = stage.func(payload)
+      except Exception as ex:
+        logging.exception(ex)
+        result = None
+        with stage.lock:
+          stage.errors += 1
+
+      with stage.lock:
+        stage.count += 1
+        stage.seconds += time.perf_counter() - start
+
+      if after and result is not None:
+        after.put(result)
+
+
+  def start(self):
+    if self.is_running:
+      raise RuntimeError('Pipeline already started')
+
+    self.is_running = True
+    self.started = time.perf_counter()
+    for i, stage in enumerate(self.stages):
+      after = self.stages[i + 1] if i + 1 < len(self.stages) else None
+      for _ in range(stage.workers):
+        thread = threading.Thread(target=self.run, args=(stage, after), daemon=True)
+        thread.start()
+        stage.threads.append(thread)
+
+    return self
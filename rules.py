@@ -0,0 +1,188 @@
+
+import logging
+
+
+class RuleSet(object):
+  def __init__(self, rules):
+    self.rules = rules
+
+    # per-rule counters, parallel to self.rules
+    self.hits = [0] * len(rules)
+
+    # (type, checks) per rule; a check is (feature, expressions) and None means "any"
+    self.compiled = [None] * len(rules)
+
+    # feature => expression => rule ids, and feature => rule ids for "is_any" matches
+    self.by_expression = {}
+    self.by_feature = {}
+
+    # feature => rule ids that match or check that feature
+    self.involved = {}
+    self.matches = [None] * len(rules)
+
+    for rule_id, rule in enumerate(rules):
+      if not self.is_enabled(rule) or not self.is_enabled(rule['match']):
+        continue
+
+      if rule['type'] == 'info':
+        continue
+
+      elif rule['type'] == 'allow':
+        checks = self.compile_checks(rule['allowed'])
+
+      elif rule['type'] == 'deny':
+        checks = self.compile_checks(rule['denied'])
+
+      else:
+        # unsupported types fail when an item matches them
+        checks = None
+
+      self.compiled[rule_id] = (rule['type'], checks)
+
+      match = rule['match']
+      if match.get('is_any'):
+        self.by_feature.setdefault(match['feature'], []).append(rule_id)
+        self.matches[rule_id] = (match['feature'], None)
+      else:
+        expressions = self.by_expression.setdefault(match['feature'], {})
+        for expression in match['expressions']:
+          expressions.setdefault(expression, []).append(rule_id)
+
+        self.matches[rule_id] = (match['feature'], frozenset(match['expressions']))
+
+      features = { match['feature'], *(feature for feature, _ in checks or ()) }
+      for feature in features:
+        self.involved.setdefault(feature, []).append(rule_id)
+
+
+  def compile_checks(self, matches):
+    checks = []
+    for match in matches:
+      if self.is_enabled(match):
+        if match.get('is_any'):
+          checks.append((match['feature'], None))
+        else:
+          checks.append((match['feature'], frozenset(match['expressions'])))
+
+    return tuple(checks)
+
+
+  def get_allowed(self, feature, expressions, partial, decided):
+    # expressions of this feature that keep every rule satisfiable, given
+    # the partial item and the features that have already been decided
+    rule_ids = self.involved.get(feature)
+    if not rule_ids:
+      return list(range(len(expressions)))
+
+    allowed = []
+    for code, expression in enumerate(expressions):
+      partial[feature] = expression
+      for rule_id in rule_ids:
+        if self.is_violated(rule_id, partial, decided):
+          break
+      else:
+        allowed.append(code)
+
+    del partial[feature]
+    return allowed
+
+
+  def get_violations(self, item):
+    # like is_valid(), but returns the ids of every rule the item breaks (and records no hits)
+    violations = []
+    for feature, expression in item.items():
+      if expression:
+        for rule_id in [*self.by_expression.get(feature, {}).get(expression, ()), *self.by_feature.get(feature, ())]:
+          rule_type, checks = self.compiled[rule_id]
+          if checks is None:
+            raise Exception("Unsupported rule type: {0}".format(rule_type))
+
+          if self.is_checked(item, checks) != (rule_type == 'allow'):
+            violations.append(rule_id)
+
+    return violations
+
+
+  @staticmethod
+  def is_enabled(rule):
+    return rule.get('is_enabled', True)
+
+
+  @staticmethod
+  def is_checked(item, checks):
+    for feature, expressions in checks:
+      expression = item.get(feature)
+      if expression and (expressions is None or expression in expressions):
+        return True
+
+    return False
+
+
+  def is_valid(self, item, throw=False, record=True):
+    triggered = []
+    for feature, expression in item.items():
+      if expression:
+        try:
+          triggered.extend(self.by_expression[feature][expression])
+        except KeyError:
+          pass
+
+        try:
+          triggered.extend(self.by_feature[feature])
+        except KeyError:
+          pass
+
+    if not triggered:
+      return True
+
+    # same order (and hit counts) as scanning rules.json top to bottom
+    triggered.sort()
+    for rule_id in triggered:
+      rule_type, checks = self.compiled[rule_id]
+      if checks is None:
+        raise Exception("Unsupported rule type: {0}".format(rule_type))
+
+      matched = self.is_checked(item, checks)
+      if matched and record:
+        self.hits[rule_id] += 1
+
+      # allow rules need a match, deny rules must not have one
+      if matched == (rule_type == 'allow'):
+        continue
+
+      if throw:
+        raise Exception(self.rules[rule_id])
+      else:
+        return False
+
+    return True
+
+
+  def is_violated(self, rule_id, partial, decided):
+    # True if the rule fails no matter how the undecided features are drawn
+    rule_type, checks = self.compiled[rule_id]
+    if checks is None:
+      return False
+
+    feature, expressions = self.matches[rule_id]
+    expression = partial.get(feature)
+    if not expression or not (expressions is None or expression in expressions):
+      return False
+
+    if self.is_checked(partial, checks):
+      return rule_type == 'deny'
+
+    # an allowed trait could still be drawn (or linked) later
+    return rule_type == 'allow' and all(feature in decided for feature, _ in checks)
+
+
+  def report(self):
+    for rule_id, rule in enumerate(self.rules):
+      if self.compiled[rule_id] is None:
+        continue
+
+      description = rule.get('description', rule_id)
+      if self.hits[rule_id]:
+        logging.info(f"RULE: {self.hits[rule_id]} hits - {description}")
+      else:
+        logging.warning(f"RULE: Not used - {description}")
@@ -0,0 +1,277 @@
+
+import bisect, hashlib, itertools, random
+
+# optional
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+
+class TraitSampler(object):
+  # one feature's expressions with precomputed cumulative mils; same draws as random.choices()
+  __slots__ = ('cum_weights', 'population', 'total')
+
+  def __init__(self, population, weights):
+    self.population = tuple(population)
+
+    # like TraitManager.randomize_traits(), equal mils draw uniformly
+    if len(set(weights)) > 1:
+      self.cum_weights = list(itertools.accumulate(weights))
+      self.total = self.cum_weights[-1]
+    else:
+      self.cum_weights = None
+      self.total = len(self.population)
+
+
+  def __len__(self):
+    return len(self.population)
+
+
+  def sample(self, rng=random):
+    if len(self.population) < 2:
+      return self.population[0] if self.population else ''
+
+    if self.cum_weights is None:
+      return self.population[int(rng.random() * self.total)]
+
+    return self.population[bisect.bisect(self.cum_weights, rng.random() * self.total, 0, len(self.population) - 1)]
+
+
+
+class BatchSampler(object):
+  def __init__(self, weights, populations):
+    # weights, populations: the output of TraitManager.compile_base_traits()
+    self.features = list(populations.keys())
+    self.populations = [populations[feature] for feature in self.features]
+    self.codes = [{ expression: code for code, expression in enumerate(population) } for population in self.populations]
+    self.cum_weights = []
+    for feature in self.features:
+      if weights[feature]:
+        self.cum_weights.append(list(itertools.accumulate(weights[feature])))
+      else:
+        self.cum_weights.append(None)
+
+    # each candidate is packed into one integer, mixed-radix over the populations
+    self.strides = []
+    self.space = 1
+    for population in self.populations:
+      self.strides.append(self.space)
+      self.space *= len(population)
+
+    self.use_numpy = np is not None and self.space < 2 ** 63
+    self.rng = self.get_rng()
+
+
+  def decode(self, key):
+    item = {}
+    for feature, population in zip(self.features, self.populations):
+      key, code = divmod(key, len(population))
+      item[feature] = population[code]
+
+    return item
+
+
+  def encode(self, item):
+    # None if the item has expressions that can't be drawn
+    key = 0
+    for feature, codes, stride in zip(self.features, self.codes, self.strides):
+      try:
+        key += codes[item[feature]] * stride
+      except KeyError:
+        return None
+
+    return key
+
+
+  def get_rng(self, seed=None):
+    if self.use_numpy:
+      return np.random.default_rng(seed)
+    else:
+      return random.Random(seed)
+
+
+  def sample(self, count, rng=None):
+    # returns distinct packed keys, in the order they were first drawn
+    rng = rng or self.rng
+    if self.use_numpy:
+      keys = np.zeros(count, dtype=np.int64)
+      for population, cum_weights, stride in zip(self.populations, self.cum_weights, self.strides):
+        if cum_weights:
+          codes = np.searchsorted(cum_weights, rng.random(count) * cum_weights[-1], side='right')
+        else:
+          codes = rng.integers(0, len(population), size=count)
+
+        keys += codes * stride
+
+      _, first = np.unique(keys, return_index=True)
+      return keys[np.sort(first)].tolist()
+
+    else:
+      keys = [0] * count
+      for population, cum_weights, stride in zip(self.populations, self.cum_weights, self.strides):
+        codes = rng.choices(range(len(population)), cum_weights=cum_weights, k=count)
+        keys = [key + code * stride for key, code in zip(keys, codes)]
+
+      return list(dict.fromkeys(keys))
+
+
+
+class UniqueSampler(BatchSampler):
+  # weighted sampling without replacement, one combination at a time
+  def __init__(self, weights, populations):
+    super().__init__(weights, populations)
+    self.weights = []
+    for population, cum_weights in zip(self.populations, self.cum_weights):
+      if cum_weights:
+        self.weights.append([b - a for a, b in zip([0, *cum_weights], cum_weights)])
+      else:
+        self.weights.append([1] * len(population))
+
+    # masses[d]: the total weight of all combinations of features d and later
+    self.masses = [1]
+    for weights in reversed(self.weights):
+      self.masses.insert(0, self.masses[0] * sum(weights))
+
+    # (depth, partial key) => weight already taken below that prefix
+    self.taken = {}
+    self.remaining = self.space
+
+
+  def draw(self, rng=None):
+    rng = rng or self.rng
+    total = self.masses[0] - self.taken.get((0, 0), 0)
+    if total <= 0:
+      return None
+
+    # walk down the features, skipping the weight that was already taken
+    target = rng.randrange(total)
+    prefix = 0
+    scale = 1
+    for depth, (weights, stride) in enumerate(zip(self.weights, self.strides)):
+      below = self.masses[depth + 1]
+      for code, weight in enumerate(weights):
+        key = prefix + code * stride
+        mass = scale * weight * below - self.taken.get((depth + 1, key), 0)
+        if target < mass:
+          prefix = key
+          scale *= weight
+          break
+
+        target -= mass
+
+    self.exclude(prefix)
+    return prefix
+
+
+  def exclude(self, key):
+    depth = len(self.features)
+    if key is None or (depth, key) in self.taken:
+      return False
+
+    codes = []
+    remainder = key
+    for population in self.populations:
+      remainder, code = divmod(remainder, len(population))
+      codes.append(code)
+
+    weight = 1
+    for code, weights in zip(codes, self.weights):
+      weight *= weights[code]
+
+    partial = 0
+    self.taken[(0, 0)] = self.taken.get((0, 0), 0) + weight
+    for depth, (code, stride) in enumerate(zip(codes, self.strides), 1):
+      partial += code * stride
+      self.taken[(depth, partial)] = self.taken.get((depth, partial), 0) + weight
+
+    self.remaining -= 1
+    return True
+
+
+  def get_rng(self, seed=None):
+    # exact integer arithmetic; the population can exceed 64 bits
+    return random.Random(seed)
+
+
+
+class ConstrainedSampler(BatchSampler):
+  # draws features in order, each one limited to the expressions that keep rules.json satisfiable
+  def __init__(self, weights, populations, rule_set):
+    super().__init__(weights, populations)
+    self.rule_set = rule_set
+    self.weights = []
+    for population, cum_weights in zip(self.populations, self.cum_weights):
+      if cum_weights:
+        self.weights.append([b - a for a, b in zip([0, *cum_weights], cum_weights)])
+      else:
+        self.weights.append([1] * len(population))
+
+    # (depth, partial key) => (allowed codes, cumulative weights)
+    self.allowed = {}
+    self.dead_ends = {}
+
+
+  def draw(self, rng=None):
+    # None if the rules leave no weight for some feature
+    rng = rng or self.rng
+    item = {}
+    decided = set()
+    prefix = 0
+    for depth, feature in enumerate(self.features):
+      decided.add(feature)
+      codes, cum_weights = self.get_allowed(depth, prefix, item, decided)
+      if not codes:
+        self.dead_ends[feature] = self.dead_ends.get(feature, 0) + 1
+        return None
+
+      code, = rng.choices(codes, cum_weights=cum_weights)
+      item[feature] = self.populations[depth][code]
+      prefix += code * self.strides[depth]
+
+    return prefix
+
+
+  def get_allowed(self, depth, prefix, item, decided):
+    try:
+      return self.allowed[(depth, prefix)]
+    except KeyError:
+      pass
+
+    feature = self.features[depth]
+    codes = self.rule_set.get_allowed(feature, self.populations[depth], item, decided)
+    weights = self.weights[depth]
+    codes = [code for code in codes if weights[code]]
+    allowed = (codes, list(itertools.accumulate(weights[code] for code in codes)))
+    if len(self.allowed) < 1000000:
+      self.allowed[(depth, prefix)] = allowed
+
+    return allowed
+
+
+  def get_rng(self, seed=None):
+    return random.Random(seed)
+
+
+
+def get_seed(seed, stream):
+  # a 64-bit seed per stream, the same in every process and platform
+  digest = hashlib.sha256(f'{seed}:{stream}'.encode()).digest()
+  return int.from_bytes(digest[:8], 'little')
+
+
+def get_quotas(weights, total):
+  # largest remainder: integer counts that sum to total, each within 1 of its exact share
+  if not weights or not sum(weights):
+    weights = [1] * len(weights)
+
+  # integer division, so large totals can't round the wrong way (mils are integers)
+  weight_sum = sum(weights)
+  shares = [divmod(total * weight, weight_sum) for weight in weights]
+  quotas = [quota for quota, _ in shares]
+  remainders = [remainder for _, remainder in shares]
+  by_remainder = sorted(range(len(weights)), key=lambda code: -remainders[code])
+  for code in by_remainder[:total - sum(quotas)]:
+    quotas[code] += 1
+
+  return quotas
@@ -0,0 +1,204 @@
+
+import heapq, os, struct, tempfile
+from array import array
+
+# optional
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+# one (score, index) pair in a ScoreSpool run
+RECORD = struct.Struct('=dq')
+
+
+class RecipeStats(object):
+  # trait counts and rarity scores over chunks of TraitCodec rows
+  def __init__(self, codec, traits):
+    self.codec = codec
+    self.counts = [[0] * len(expressions) for expressions in codec.expressions]
+    self.total = 0
+
+    # mils per code; code 0 (no trait) has none
+    self.mils = []
+    for feature, expressions in zip(codec.features, codec.expressions):
+      self.mils.append([0] + [traits[feature][expression]['mils'] for expression in expressions[1:]])
+
+    self.rarity = None
+
+
+  def add(self, rows):
+    # pass 1: counts
+    width = self.codec.width
+    count = len(rows) // width if width else 0
+    self.total += count
+    if np is not None and count:
+      matrix = self.to_matrix(rows)
+      for column, counts in enumerate(self.counts):
+        for code, n in enumerate(np.bincount(matrix[:, column], minlength=len(counts)).tolist()):
+          counts[code] += n
+
+    else:
+      for column, counts in enumerate(self.counts):
+        for code in rows[column::width]:
+          counts[code] += 1
+
+
+  def get_features(self):
+    # per feature: items with the feature, chi-square against mils, and the traits
+    features = []
+    for feature, expressions, counts, mils in zip(self.codec.features, self.codec.expressions, self.counts, self.mils):
+      present = self.total - counts[0]
+      mils_sum = sum(mils)
+
+      chi_square = 0.0
+      degrees = -1
+      traits = []
+      for code in range(1, len(expressions)):
+        expected = present * mils[code] / mils_sum if mils_sum else 0.0
+        if expected:
+          chi_square += (counts[code] - expected) ** 2 / expected
+          degrees += 1
+
+        traits.append({
+          'expression': expressions[code],
+          'count':      counts[code],
+          'share':      counts[code] / present if present else 0.0,
+          'mils':       mils[code],
+          'expected':   expected,
+          'deviation':  (counts[code] - expected) / expected if expected else None,
+          'rarity':     self.total / counts[code] if counts[code] else None
+        })
+
+      features.append({
+        'feature':    feature,
+        'count':      present,
+        'chi_square': chi_square,
+        'degrees':    max(0, degrees),
+        'traits':     traits
+      })
+
+    return features
+
+
+  def get_scores(self, rows):
+    # pass 2: each item's score is the sum of 1 / frequency of its traits
+    if self.rarity is None:
+      self.rarity = [[0.0] + [self.total / n if n else 0.0 for n in counts[1:]] for counts in self.counts]
+
+    width = self.codec.width
+    if np is not None and len(rows):
+      matrix = self.to_matrix(rows)
+      scores = np.zeros(len(matrix), dtype=np.float64)
+      for column, rarity in enumerate(self.rarity):
+        scores += np.asarray(rarity)[matrix[:, column]]
+
+      return array('d', scores.tobytes())
+
+    scores = array('d')
+    for offset in range(0, len(rows), width):
+      row = rows[offset:offset + width]
+      scores.append(sum(rarity[code] for rarity, code in zip(self.rarity, row)))
+
+    return scores
+
+
+  def to_matrix(self, rows):
+    dtype = np.uint8 if self.codec.typecode == 'B' else np.uint32
+    return np.frombuffer(rows, dtype=dtype).reshape(-1, self.codec.width)
+
+
+
+class ScoreSpool(object):
+  # (score, index) pairs spooled to sorted runs on disk, then merged into ranks
+  def __init__(self, path=None, fan_in=64):
+    self.fan_in = fan_in
+    self.folder = tempfile.TemporaryDirectory(dir=path)
+    self.runs = []
+    self.written = 0
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+
+  def add(self, indexes, scores):
+    # one run per chunk, rarest first; equal scores keep their order
+    if np is not None:
+      order = np.argsort(-np.frombuffer(scores, dtype=np.float64), kind='stable')
+      records = np.empty(len(order), dtype=[('score', '=f8'), ('index', '=i8')])
+      records['score'] = np.frombuffer(scores, dtype=np.float64)[order]
+      records['index'] = np.frombuffer(indexes, dtype=np.int64)[order]
+      path = self.get_path()
+      with open(path, 'wb') as fd:
+        fd.write(records.tobytes())
+
+      self.runs.append((path, len(records)))
+
+    else:
+      order = sorted(range(len(scores)), key=lambda i: -scores[i])
+      self.write_run((scores[i], indexes[i]) for i in order)
+
+
+  def close(self):
+    self.folder.cleanup()
+
+
+  def get_path(self):
+    path = os.path.join(self.folder.name, str(self.written))
+    self.written += 1
+    return path
+
+
+  def get_ranks(self):
+    # yields (rank, index, score), rarest first; 1 is the rarest and equal scores share a rank
+    # at most fan_in runs are open at once, so earlier runs are merged in passes
+    while len(self.runs) > self.fan_in:
+      runs = self.runs
+      self.runs = []
+      for offset in range(0, len(runs), self.fan_in):
+        self.write_run(self.merge(runs[offset:offset + self.fan_in]))
+        for path, _ in runs[offset:offset + self.fan_in]:
+          os.remove(path)
+
+    previous = None
+    for position, (score, index) in enumerate(self.merge(self.runs), 1):
+      if score != previous:
+        rank = position
+        previous = score
+
+      yield (rank, index, score)
+
+
+  def merge(self, runs):
+    # equal scores come from the earlier run first, so the merge is stable
+    return heapq.merge(*[self.read_run(path, length) for path, length in runs], key=lambda pair: -pair[0])
+
+
+  @staticmethod
+  def read_run(path, length, block=4096):
+    with open(path, 'rb') as fd:
+      for offset in range(0, length, block):
+        count = min(block, length - offset)
+        yield from RECORD.iter_unpack(fd.read(count * RECORD.size))
+
+
+  def write_run(self, pairs, block=4096):
+    path = self.get_path()
+    length = 0
+    with open(path, 'wb') as fd:
+      buffer = bytearray()
+      for pair in pairs:
+        buffer += RECORD.pack(*pair)
+        length += 1
+        if len(buffer) >= block * RECORD.size:
+          fd.write(buffer)
+          buffer.clear()
+
+      fd.write(buffer)
+
+    self.runs.append((path, length))
@@ -0,0 +1,53 @@
+import pytest
+from PIL import Image
+
+from compositors import NumpyCompositor, PillowCompositor
+from layers import Layer
+
+np = pytest.importorskip('numpy')
+
+
+def get_layers(seed, count=4, size=(48, 32)):
+  # random RGBA layers, some covering only part of the canvas
+  rng = np.random.default_rng(seed)
+  layers = []
+  for i in range(count):
+    pixels = rng.integers(0, 256, (size[1], size[0], 4), dtype=np.uint8)
+    if i:
+      pixels[..., 3] = rng.choice([0, 0, 64, 128, 200, 255], (size[1], size[0]))
+      x, y = rng.integers(0, size[0] // 2), rng.integers(0, size[1] // 2)
+      pixels[:y] = 0
+      pixels[:, :x] = 0
+    else:
+      pixels[..., 3] = 255
+
+    layers.append(Layer.crop(Image.fromarray(pixels, 'RGBA')))
+
+  return layers
+
+
+def render(compositor, layers):
+  canvas = compositor.new_canvas(layers[0])
+  for layer in layers[1:]:
+    canvas = compositor.blend(canvas, layer)
+
+  return np.asarray(compositor.to_image(canvas), dtype=np.int16)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_numpy_matches_pillow(seed):
+  layers = get_layers(seed)
+  expected = render(PillowCompositor(), layers)
+  actual = render(NumpyCompositor(), layers)
+  assert np.abs(expected - actual).max() <= 1
+
+
+def test_transparent_base():
+  # colors are meaningless where both images are fully transparent
+  layers = get_layers(5)
+  layers[0] = Layer.crop(Image.new('RGBA', layers[0].size))
+  expected = render(PillowCompositor(), layers)
+  actual = render(NumpyCompositor(), layers)
+  visible = (expected[..., 3:4] > 0) | (actual[..., 3:4] > 0)
+  assert np.abs(expected - actual)[..., 3].max() <= 1
+  assert (np.abs(expected - actual)[..., :3] * visible).max() <= 1
@@ -0,0 +1,156 @@
+import itertools
+import pytest
+
+from counters import RecipeCounter
+from rules import RuleSet
+
+
+def get_traits(spec):
+  # feature => expression => (mils, link:feature, link:expression)
+  traits = {}
+  for feature, expressions in spec.items():
+    traits[feature] = {}
+    for expression, (mils, link_feature, link_expression) in expressions.items():
+      traits[feature][expression] = {
+        'feature':         feature,
+        'expression':      expression,
+        'mils':            mils,
+        'link:feature':    link_feature,
+        'link:expression': link_expression
+      }
+
+  return traits
+
+
+def get_options(traits, feature):
+  weights = { expression: trait['mils'] for expression, trait in traits[feature].items() }
+  if len(set(weights.values())) == 1:
+    weights = { expression: 1 for expression in weights }
+
+  total = sum(weights.values())
+  return [(expression, weight / total) for expression, weight in weights.items() if weight]
+
+
+def resolve(traits, item, p):
+  # every (item, probability) that following the links in item order can produce
+  results = [(dict(item), p)]
+  for feature in list(item):
+    expanded = []
+    for partial, q in results:
+      pending = [(partial, q, feature, item[feature])]
+      while pending:
+        current, r, key, value = pending.pop()
+        trait = traits[key][value]
+        if not trait['link:feature']:
+          expanded.append((current, r))
+          continue
+
+        target = trait['link:feature']
+        if trait['link:expression'] == '*':
+          options = get_options(traits, target)
+        else:
+          options = [(trait['link:expression'], 1.0)]
+
+        for expression, s in options:
+          pending.append(({ **current, target: expression }, r * s, target, expression))
+
+    results = expanded
+
+  return results
+
+
+def brute_force(traits, base, rule_set):
+  items = set()
+  probability = 0.0
+  options = [get_options(traits, feature) for feature in base]
+  for combination in itertools.product(*options):
+    item = { feature: expression for feature, (expression, _) in zip(base, combination) }
+    p = 1.0
+    for _, q in combination:
+      p *= q
+
+    for resolved, q in resolve(traits, item, p):
+      if rule_set.is_valid(resolved, record=False):
+        items.add(tuple(sorted(resolved.items())))
+        probability += q
+
+  return (len(items), probability)
+
+
+def count(traits, base, rules=(), limit=1000000):
+  populations = {}
+  weights = {}
+  for feature in base:
+    expressions = [trait for trait in traits[feature].values() if trait['mils']]
+    populations[feature] = [trait['expression'] for trait in expressions]
+    weights[feature] = [trait['mils'] for trait in expressions]
+
+  rule_set = RuleSet(list(rules))
+  return (RecipeCounter(weights, populations, traits, rule_set, limit).count(), brute_force(traits, base, rule_set))
+
+
+def deny(feature, expressions, denied_feature, denied):
+  return {
+    "type":   "deny",
+    "match":  { "feature": feature, "is_any": False, "expressions": expressions },
+    "denied": [{ "feature": denied_feature, "is_any": False, "expressions": denied }]
+  }
+
+
+SPECS = {
+  'independent': {
+    'A': { 'a1': (1, '', ''), 'a2': (3, '', ''), 'a3': (2, '', '') },
+    'B': { 'b1': (1, '', ''), 'b2': (1, '', '') }
+  },
+  'shared link': {
+    'A': { 'a1': (1, 'C', '*'), 'a2': (1, 'C', '*') },
+    'B': { 'b1': (1, 'C', '*') },
+    'C': { 'c1': (1, '', ''), 'c2': (1, '', '') }
+  },
+  'fixed link to a base feature': {
+    'A': { 'a1': (1, 'B', 'b2'), 'a2': (2, '', '') },
+    'B': { 'b1': (1, '', ''), 'b2': (3, '', '') }
+  },
+  'random link chain': {
+    'A': { 'a1': (1, 'C', '*'), 'a2': (1, '', '') },
+    'B': { 'b1': (1, '', ''), 'b2': (1, '', '') },
+    'C': { 'c1': (2, 'D', 'd1'), 'c2': (1, '', '') },
+    'D': { 'd1': (1, '', ''), 'd2': (1, '', '') }
+  }
+}
+
+
+@pytest.mark.parametrize('name', SPECS)
+def test_count_matches_brute_force(name):
+  traits = get_traits(SPECS[name])
+  base = [feature for feature in traits if feature in ('A', 'B')]
+  (total, probability, margin), (expected, expected_probability) = count(traits, base)
+  assert (total, margin) == (expected, 0)
+  assert probability == pytest.approx(expected_probability)
+
+
+def test_shared_link_is_deduplicated():
+  traits = get_traits(SPECS['shared link'])
+  (total, _, _), _ = count(traits, ['A', 'B'])
+  assert total == 4
+
+
+@pytest.mark.parametrize('name', SPECS)
+def test_count_with_rules(name):
+  traits = get_traits(SPECS[name])
+  base = [feature for feature in traits if feature in ('A', 'B')]
+  rules = [deny('A', ['a1'], 'B', ['b1']), deny('B', ['b2'], 'C', ['c2'])]
+  (total, probability, margin), (expected, expected_probability) = count(traits, base, rules)
+  assert (total, margin) == (expected, 0)
+  assert probability == pytest.approx(expected_probability)
+
+
+def test_estimate_past_limit():
+  traits = get_traits({
+    feature: { f'{feature}{i}': (1, '', '') for i in range(10) } for feature in 'ABCD'
+  })
+  rules = [deny('A', ['A0'], 'B', ['B0', 'B1'])]
+  (total, probability, margin), (expected, expected_probability) = count(traits, list('ABCD'), rules, limit=50)
+  assert margin > 0
+  assert abs(total - expected) <= 2 * margin
+  assert probability == pytest.approx(expected_probability, abs=0.01)
@@ -0,0 +1,114 @@
+import copy
+import random
+
+import pytest
+
+from impl import TraitManager
+from rules import RuleSet
+
+
+FEATURES = { f'F{k}': [f'F{k}_{j}' for j in range(6)] for k in range(5) }
+
+
+def get_match(rng):
+  feature = rng.choice(list(FEATURES))
+  match = { 'feature': feature, 'is_any': rng.random() < 0.15, 'expressions': rng.sample(FEATURES[feature], rng.randint(1, 3)) }
+  if rng.random() < 0.1:
+    match['is_enabled'] = False
+
+  return match
+
+
+def get_rules(seed, count=12):
+  rng = random.Random(seed)
+  rules = []
+  for _ in range(count):
+    rule = {
+      'type':    rng.choice(['allow', 'deny', 'deny', 'info']),
+      'match':   get_match(rng),
+      'allowed': [get_match(rng) for _ in range(rng.randint(1, 2))],
+      'denied':  [get_match(rng) for _ in range(rng.randint(1, 2))]
+    }
+    if rng.random() < 0.1:
+      rule['is_enabled'] = False
+
+    rules.append(rule)
+
+  return rules
+
+
+def get_items(seed, count=2000):
+  rng = random.Random(seed)
+  items = []
+  for _ in range(count):
+    # '' is an empty slot, which matches nothing
+    items.append({ feature: rng.choice(['', *expressions]) for feature, expressions in FEATURES.items() })
+
+  return items
+
+
+def linear_scan(rules, item):
+  # is_item_valid before RuleSet: every rule, top to bottom
+  for rule in rules:
+    if not TraitManager.is_rule_enabled(rule):
+      continue
+
+    if not TraitManager.is_item_match(item, rule['match']):
+      continue
+
+    if rule['type'] == 'allow':
+      if not TraitManager.is_item_allowed(item, rule):
+        return False
+
+    elif rule['type'] == 'deny':
+      if TraitManager.is_item_denied(item, rule):
+        return False
+
+    elif rule['type'] != 'info':
+      raise Exception("Unsupported rule type: {0}".format(rule['type']))
+
+  return True
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_is_valid_matches_linear_scan(seed):
+  rules = get_rules(seed)
+  scanned = copy.deepcopy(rules)
+  rule_set = RuleSet(rules)
+  for item in get_items(seed):
+    assert rule_set.is_valid(item) == linear_scan(scanned, item), item
+
+  assert rule_set.hits == [rule.get('hits', 0) for rule in scanned]
+
+
+def test_is_valid_without_record():
+  rules = get_rules(0)
+  rule_set = RuleSet(rules)
+  for item in get_items(0, 200):
+    rule_set.is_valid(item, record=False)
+
+  assert rule_set.hits == [0] * len(rules)
+
+
+def test_throw_names_first_broken_rule():
+  rules = get_rules(1)
+  scanned = copy.deepcopy(rules)
+  rule_set = RuleSet(rules)
+  for item in get_items(1, 200):
+    if linear_scan(scanned, item):
+      continue
+
+    # the rule a top to bottom scan stops at
+    broken = next(rule for rule in rules if not linear_scan([rule], item))
+    with pytest.raises(Exception) as error:
+      rule_set.is_valid(item, throw=True)
+
+    assert error.value.args[0] is broken
+
+
+def test_unsupported_type():
+  rules = [{ 'type': 'conflict', 'match': { 'feature': 'F0', 'expressions': ['F0_0'] } }]
+  rule_set = RuleSet(rules)
+  assert rule_set.is_valid({ 'F0': 'F0_1' })
+  with pytest.raises(Exception, match='Unsupported rule type'):
+    rule_set.is_valid({ 'F0': 'F0_0' })
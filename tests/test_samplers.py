@@ -0,0 +1,116 @@
+import itertools
+import random
+
+import pytest
+
+from impl import TraitManager
+from rules import RuleSet
+from samplers import UniqueSampler, get_quotas
+
+
+def get_manager(sizes, quantity):
+  manager = TraitManager()
+  manager.traits = {}
+  for k, size in enumerate(sizes):
+    feature = f'F{k}'
+    manager.traits[feature] = {}
+    for j in range(size):
+      manager.traits[feature][f'{feature}_{j}'] = {
+        'feature':         feature,
+        'expression':      f'{feature}_{j}',
+        'mils':            j + 1,
+        'link:feature':    '',
+        'link:expression': ''
+      }
+
+  manager.compile_trait_samplers()
+  manager.compile_links()
+  manager.rules = []
+  manager.rule_set = RuleSet([])
+  manager.BASE_TRAITS = list(manager.traits)
+  manager.COUNT_ITEMS = False
+  manager.QUANTITY = quantity
+  manager.SAMPLER = 'unique'
+  manager.SEED = 1
+  return manager
+
+
+def get_sampler(sizes, weighted=True):
+  populations = { f'F{k}': [f'F{k}_{j}' for j in range(size)] for k, size in enumerate(sizes) }
+  weights = { feature: list(range(1, len(population) + 1)) if weighted else None for feature, population in populations.items() }
+  return UniqueSampler(weights, populations)
+
+
+@pytest.mark.parametrize('weighted', [True, False])
+def test_unique_sampler_never_repeats(weighted):
+  sampler = get_sampler([3, 4, 2], weighted)
+  rng = random.Random(1)
+  keys = [sampler.draw(rng) for _ in range(sampler.space)]
+  assert sorted(keys) == list(range(sampler.space))
+  assert sampler.remaining == 0
+  assert sampler.draw(rng) is None
+
+
+def test_unique_sampler_skips_excluded():
+  sampler = get_sampler([3, 4, 2])
+  excluded = { sampler.encode({ 'F0': 'F0_1', 'F1': 'F1_3', 'F2': 'F2_0' }), 0, 5 }
+  for key in excluded:
+    assert sampler.exclude(key)
+
+  # excluding twice changes nothing
+  assert not sampler.exclude(0)
+  assert sampler.remaining == sampler.space - len(excluded)
+
+  rng = random.Random(2)
+  keys = [sampler.draw(rng) for _ in range(sampler.remaining)]
+  assert len(set(keys)) == len(keys)
+  assert set(keys) == set(range(sampler.space)) - excluded
+  assert sampler.draw(rng) is None
+
+
+def test_unique_sampler_follows_weights():
+  # the first draw picks each combination in proportion to its weight
+  sampler = get_sampler([2, 3])
+  counts = [0] * sampler.space
+  rng = random.Random(3)
+  for _ in range(30000):
+    sampler.taken = {}
+    sampler.remaining = sampler.space
+    counts[sampler.draw(rng)] += 1
+
+  weights = [a * b for b, a in itertools.product([1, 2, 3], [1, 2])]
+  for count, weight in zip(counts, weights):
+    assert count / 30000 == pytest.approx(weight / sum(weights), abs=0.01)
+
+
+def test_randomize_unique_returns_every_combination():
+  manager = get_manager([3, 4], 12)
+  items = list(manager.randomize())
+  assert len(items) == 12
+  assert len({ (item['F0'], item['F1']) for item in items }) == 12
+
+
+def test_randomize_unique_rejects_large_quantity():
+  manager = get_manager([3, 4], 13)
+  with pytest.raises(Exception, match='QUANTITY requires 13 more items, but only 12'):
+    list(manager.randomize())
+
+
+@pytest.mark.parametrize('weights, total', [
+  ([1, 2, 3], 10),
+  ([5, 5, 5], 7),
+  ([1000, 1, 1], 3),
+  ([0, 0, 0], 5),
+  ([7], 0),
+  ([3, 1, 4, 1, 5, 9, 2, 6], 10 ** 18 + 7),
+  ([], 0)
+])
+def test_get_quotas_sums_to_total(weights, total):
+  quotas = get_quotas(weights, total)
+  assert len(quotas) == len(weights)
+  assert sum(quotas) == total
+
+  # each quota is within 1 of its exact share
+  shares = weights if sum(weights) else [1] * len(weights)
+  for quota, weight in zip(quotas, shares):
+    assert abs(quota * sum(shares) - total * weight) < sum(shares)
@@ -0,0 +1,43 @@
+import random
+from array import array
+
+import pytest
+
+import stats
+from stats import ScoreSpool
+
+
+def spool_runs(spool, runs, seed=1):
+  # returns every (score, index) added, in index order
+  rng = random.Random(seed)
+  pairs = []
+  for _ in range(runs):
+    count = rng.randint(0, 50)
+    scores = array('d', [float(rng.randint(0, 20)) for _ in range(count)])
+    indexes = array('q', range(len(pairs), len(pairs) + count))
+    pairs.extend(zip(scores, indexes))
+    spool.add(indexes, scores)
+
+  return pairs
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_ranks_merge_in_passes(monkeypatch, use_numpy):
+  if not use_numpy:
+    monkeypatch.setattr(stats, 'np', None)
+  elif stats.np is None:
+    pytest.skip('numpy is not installed')
+
+  with ScoreSpool(fan_in=3) as spool:
+    pairs = spool_runs(spool, 40)
+    ranks = list(spool.get_ranks())
+
+  # rarest first, equal scores in index order
+  expected = sorted(pairs, key=lambda pair: -pair[0])
+  assert [(index, score) for _, index, score in ranks] == [(index, score) for score, index in expected]
+
+  for position, (rank, _, score) in enumerate(ranks):
+    if position and score == ranks[position - 1][2]:
+      assert rank == ranks[position - 1][0]
+    else:
+      assert rank == position + 1